@@ -2,9 +2,12 @@
 See CONTRIBUTING.md for a description of the project structure and the internal logic.
 """
 
+import concurrent.futures
 import ctypes
 import logging
 import os
+import threading
+import time
 
 from cppimport.find import _check_first_line_contains_cppimport
 
@@ -23,10 +26,45 @@ settings = dict(
     lock_suffix=".lock",
     lock_timeout=10 * 60,
     remove_strict_prototypes=True,
+    discover_dependencies=True,  # Track headers reported by the compiler
+    checksum_hash="blake2b",  # Any hashlib algorithm, or e.g. "xxh3_64" if installed
     release_mode=os.getenv("CPPIMPORT_RELEASE_MODE", "0").lower()
     in ("true", "yes", "1"),
+    cache_dir=os.getenv(
+        "CPPIMPORT_CACHE_DIR",
+        os.path.join(os.getenv("XDG_CACHE_HOME", "~/.cache"), "cppimport"),
+    ),
+    # Store extensions outside of the source tree, see importer.get_build_dir
+    build_dir=os.getenv("CPPIMPORT_BUILD_DIR"),
+    object_cache=os.getenv("CPPIMPORT_OBJECT_CACHE", "0").lower()
+    in ("true", "yes", "1"),
+    object_cache_max_size=2 * 1024**3,  # in bytes
+    # Precompile pybind11/pybind11.h in modules using setup_pybind11(cfg)
+    pybind11_pch=os.getenv("CPPIMPORT_PYBIND11_PCH", "0").lower()
+    in ("true", "yes", "1"),
+    # Maximum number of concurrent compiler processes. 0 means one per CPU.
+    jobs=int(os.getenv("CPPIMPORT_JOBS", "0")),
+    # Path to a manifest written by `python -m cppimport build --manifest PATH`
+    manifest=os.getenv("CPPIMPORT_MANIFEST"),
+    manifest_verify=os.getenv("CPPIMPORT_MANIFEST_VERIFY", "0").lower()
+    in ("true", "yes", "1"),
+    # Build and load modules imported via the import hook on first use
+    lazy=os.getenv("CPPIMPORT_LAZY", "0").lower() in ("true", "yes", "1"),
+    # Let a daemon started with `python -m cppimport serve` build modules
+    use_daemon=os.getenv("CPPIMPORT_USE_DAEMON", "1").lower() in ("true", "yes", "1"),
+    daemon_socket=os.getenv("CPPIMPORT_DAEMON_SOCKET"),  # <cache_dir>/daemon.sock
+    # Directory, http(s) URL or ArtifactStore shared between build machines
+    artifact_store=os.getenv("CPPIMPORT_ARTIFACT_STORE"),
+    # One of cppimport.profiles.PROFILES, overriding cfg['profile']
+    build_profile=os.getenv("CPPIMPORT_BUILD_PROFILE"),
+    # Profile-guided optimization: "generate" or "use", see cppimport.pgo
+    pgo=os.getenv("CPPIMPORT_PGO"),
+    # Write the timing of each import phase to this Chrome trace file at exit
+    trace=os.getenv("CPPIMPORT_TRACE"),
 )
 _logger = logging.getLogger("cppimport")
+_background_executor = None
+_background_executor_lock = threading.Lock()
 
 
 def imp(fullname, opt_in=False):
@@ -46,6 +84,12 @@ def imp(fullname, opt_in=False):
     module : the compiled and loaded Python extension module
     """
     from cppimport.find import find_module_cpppath
+    from cppimport.manifest import lookup_module_data
+
+    # A prebuilt module listed in the manifest doesn't need to be searched for.
+    module_data = lookup_module_data(fullname)
+    if module_data is not None:
+        return _imp_from_module_data(module_data)
 
     # Search through sys.path to find a file that matches the module
     filepath = find_module_cpppath(fullname, opt_in)
@@ -67,18 +111,23 @@ def imp_from_filepath(filepath, fullname=None):
     -------
     module : the compiled and loaded Python extension module
     """
+    from cppimport.importer import setup_module_data
+
+    filepath = os.path.abspath(filepath)
+    if fullname is None:
+        fullname = os.path.splitext(os.path.basename(filepath))[0]
+    module_data = setup_module_data(fullname, filepath)
+    return _imp_from_module_data(module_data)
+
+
+def _imp_from_module_data(module_data):
     from cppimport.importer import (
         build_safely,
         is_build_needed,
         load_module,
-        setup_module_data,
         try_load,
     )
 
-    filepath = os.path.abspath(filepath)
-    if fullname is None:
-        fullname = os.path.splitext(os.path.basename(filepath))[0]
-    module_data = setup_module_data(fullname, filepath)
     # The call to try_load is necessary here because there are times when the
     # only evidence a rebuild is needed comes from attempting to load an
     # existing extension module. For example, if the extension was built on a
@@ -86,11 +135,77 @@ def imp_from_filepath(filepath, fullname=None):
     # an error when loaded, then the load will fail. In that situation, we will
     # need to rebuild.
     if is_build_needed(module_data) or not try_load(module_data):
-        build_safely(filepath, module_data)
+        build_safely(module_data["filepath"], module_data)
     load_module(module_data)
     return module_data["module"]
 
 
+def imp_async(fullname, opt_in=False):
+    """
+    `imp_async` is like `imp` but builds and imports the module in a background
+    thread, so that the calling thread can continue with other work while the
+    module compiles.
+
+    Parameters
+    ----------
+    fullname : the name of the module to import.
+    opt_in : see `imp`.
+
+    Returns
+    -------
+    future : a `concurrent.futures.Future` that resolves to the module. Use
+             `asyncio.wrap_future` to await it from a coroutine.
+    """
+    return _get_background_executor().submit(imp, fullname, opt_in)
+
+
+def prebuild(fullnames):
+    """
+    `prebuild` starts building the given modules in the background without
+    importing them, for example at process start while the rest of the
+    application initializes. Importing a module later only waits for its
+    build to finish, if it hasn't already.
+
+    Parameters
+    ----------
+    fullnames : the names of the modules to build.
+
+    Returns
+    -------
+    futures : a `concurrent.futures.Future` for each module that resolves to the
+              path of the compiled extension.
+    """
+    executor = _get_background_executor()
+    return [executor.submit(_build_without_loading, name) for name in fullnames]
+
+
+def _get_background_executor():
+    global _background_executor
+    with _background_executor_lock:
+        if _background_executor is None:
+            # The compiler processes are limited by the compile scheduler, so
+            # the threads mostly wait for those.
+            _background_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=settings["jobs"] or os.cpu_count() or 1,
+                thread_name_prefix="cppimport-build",
+            )
+        return _background_executor
+
+
+def _build_without_loading(fullname):
+    from cppimport.find import find_module_cpppath
+    from cppimport.importer import build_safely, is_build_needed, setup_module_data
+    from cppimport.manifest import lookup_module_data
+
+    module_data = lookup_module_data(fullname)
+    if module_data is None:
+        filepath = find_module_cpppath(fullname)
+        module_data = setup_module_data(fullname, filepath)
+    if is_build_needed(module_data):
+        build_safely(module_data["filepath"], module_data)
+    return module_data["ext_path"]
+
+
 def build(fullname):
     """
     `build` builds a extension module like `imp` but does not import the
@@ -143,7 +258,7 @@ def build_filepath(filepath, fullname=None):
     return module_data["ext_path"]
 
 
-def build_all(root_directory):
+def build_all(root_directory, jobs=1):
     """
     `build_all` builds a extension module like `build` for each eligible (that is,
     containing the "cppimport" header) source file within the given `root_directory`.
@@ -151,17 +266,109 @@ def build_all(root_directory):
     Parameters
     ----------
     root_directory : the root directory to search for cpp source files in.
+    jobs : the number of modules to build concurrently, each in its own
+           process. If `None` or 0, the number of CPUs is used.
+
+    Returns
+    -------
+    ext_paths : the paths to the compiled extensions.
     """
-    for directory, _, files in os.walk(root_directory):
-        for file in files:
+    filepaths = _find_buildable_filepaths(root_directory)
+
+    if not jobs:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, max(len(filepaths), 1))
+
+    t = time.time()
+    ext_paths = []
+    failures = []
+
+    def record(i, full_path, get_result):
+        try:
+            ext_paths.append(get_result())
+            _logger.info(f"[{i}/{len(filepaths)}] Built: {full_path}")
+        # setuptools reports compilation errors by raising SystemExit.
+        except (Exception, SystemExit) as e:
+            _logger.error(f"[{i}/{len(filepaths)}] Failed to build: {full_path}")
+            failures.append((full_path, e))
+
+    if jobs == 1:
+        for i, full_path in enumerate(filepaths, start=1):
+            _logger.info(f"Building: {full_path}")
+            record(i, full_path, lambda: build_filepath(full_path))
+    else:
+        # Each process gets a copy of the current settings so that e.g.
+        # `force_rebuild` is respected regardless of the start method.
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=settings.update, initargs=(settings,)
+        ) as executor:
+            futures = {
+                executor.submit(build_filepath, full_path): full_path
+                for full_path in filepaths
+            }
+            for i, future in enumerate(
+                concurrent.futures.as_completed(futures), start=1
+            ):
+                record(i, futures[future], future.result)
+
+    _logger.info(
+        f"Built {len(ext_paths)} of {len(filepaths)} modules in "
+        f"{time.time() - t:.1f}s using {jobs} job(s)."
+    )
+    if failures:
+        for full_path, e in failures:
+            _logger.error(f"Failed to build {full_path}: {e!r}")
+        # The remaining modules were still built so that a single failure
+        # doesn't hide the others.
+        raise failures[0][1]
+    return ext_paths
+
+
+def watch(roots, interval=0.5, debounce=0.25):
+    """
+    `watch` starts rebuilding the modules found in `roots` in a background
+    thread whenever their sources or the headers they depend on change, so that
+    the next import finds an up-to-date extension.
+
+    Parameters
+    ----------
+    roots : directories to search for source files containing the "cppimport"
+            header, like `build_all`, or individual source files.
+    interval : how often to check for changes, in seconds.
+    debounce : how long a module's files must stay unchanged before it is
+               rebuilt, in seconds, so that a burst of saves results in a
+               single build.
+
+    Returns
+    -------
+    watcher : the `cppimport.watcher.Watcher` thread. Call its `stop` method to
+              stop watching.
+    """
+    from cppimport.watcher import Watcher
+
+    watcher = Watcher(roots, interval=interval, debounce=debounce)
+    watcher.start()
+    return watcher
+
+
+def _find_buildable_filepaths(root_directory):
+    filepaths = []
+    for directory, dirnames, files in os.walk(root_directory):
+        dirnames.sort()
+        for file in sorted(files):
             if (
                 not file.startswith(".")
                 and os.path.splitext(file)[1] in settings["file_exts"]
             ):
                 full_path = os.path.join(directory, file)
                 if _check_first_line_contains_cppimport(full_path):
-                    _logger.info(f"Building: {full_path}")
-                    build_filepath(full_path)
+                    filepaths.append(full_path)
+    return filepaths
+
+
+def _module_name(filepath, root):
+    relpath = os.path.splitext(os.path.relpath(filepath, root))[0]
+    return relpath.replace(os.sep, ".")
 
 
 ######## BACKWARDS COMPATIBILITY #########
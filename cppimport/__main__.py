@@ -3,7 +3,16 @@ import logging
 import os
 import sys
 
-from cppimport import build_all, build_filepath, settings
+from cppimport import (
+    _find_buildable_filepaths,
+    _module_name,
+    build_all,
+    build_filepath,
+    settings,
+    watch,
+)
+from cppimport.daemon import serve
+from cppimport.manifest import write_manifest
 
 
 def _run_from_commandline(raw_args):
@@ -33,6 +42,82 @@ def _run_from_commandline(raw_args):
     build_parser.add_argument(
         "--force", "-f", action="store_true", help="Force rebuild."
     )
+    build_parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="The number of modules to build concurrently. Use 0 for the "
+        "number of CPUs.",
+    )
+    build_parser.add_argument(
+        "--profile",
+        "-p",
+        help="The build profile, e.g. release, native, debug or sanitize.",
+    )
+    pgo_group = build_parser.add_mutually_exclusive_group()
+    pgo_group.add_argument(
+        "--pgo-generate",
+        action="store_const",
+        const="generate",
+        dest="pgo",
+        help="Build instrumented modules that record profile data when run.",
+    )
+    pgo_group.add_argument(
+        "--pgo-use",
+        action="store_const",
+        const="use",
+        dest="pgo",
+        help="Build modules optimized with the recorded profile data.",
+    )
+    build_parser.add_argument(
+        "--manifest",
+        "-m",
+        help="Write a manifest of the built modules to this path. Modules found "
+        "in a directory are named by their path relative to that directory.",
+    )
+
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Run a daemon that builds modules for other processes.",
+    )
+    serve_parser.add_argument(
+        "--socket",
+        "-s",
+        help="The Unix socket to listen on. Defaults to daemon.sock in the "
+        "cache directory.",
+    )
+    serve_parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        help="The maximum number of modules to build at the same time. Use 0 "
+        "for the number of CPUs.",
+    )
+
+    watch_parser = subparsers.add_parser(
+        "watch",
+        help="Rebuild modules in the background whenever their files change.",
+    )
+    watch_parser.add_argument(
+        "root",
+        help="The files or directories to watch. Directories are searched for "
+        "eligible source files like with the build command.",
+        nargs="*",
+    )
+    watch_parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.5,
+        help="How often to check for changes, in seconds.",
+    )
+    watch_parser.add_argument(
+        "--debounce",
+        type=float,
+        default=0.25,
+        help="How long the files of a module must stay unchanged before it is "
+        "rebuilt, in seconds.",
+    )
 
     args = parser.parse_args(raw_args[1:])
 
@@ -46,17 +131,41 @@ def _run_from_commandline(raw_args):
     if args.action == "build":
         if args.force:
             settings["force_rebuild"] = True
+        if args.profile:
+            settings["build_profile"] = args.profile
+        if args.pgo:
+            settings["pgo"] = args.pgo
 
+        modules = []
         for path in args.root or ["."]:
             path = os.path.abspath(os.path.expandvars(path))
             if os.path.isfile(path):
                 build_filepath(path)
+                modules.append((_module_name(path, os.path.dirname(path)), path))
             elif os.path.isdir(path):
-                build_all(path or os.getcwd())
+                build_all(path or os.getcwd(), jobs=args.jobs)
+                modules += [
+                    (_module_name(filepath, path), filepath)
+                    for filepath in _find_buildable_filepaths(path)
+                ]
             else:
                 raise FileNotFoundError(
                     f'The given root path "{path}" could not be found.'
                 )
+
+        if args.manifest:
+            write_manifest(args.manifest, modules)
+    elif args.action == "watch":
+        watcher = watch(
+            args.root or ["."], interval=args.interval, debounce=args.debounce
+        )
+        try:
+            while watcher.is_alive():
+                watcher.join(1)
+        except KeyboardInterrupt:
+            watcher.stop()
+    elif args.action == "serve":
+        serve(args.socket, jobs=args.jobs)
     else:
         parser.print_usage()
 
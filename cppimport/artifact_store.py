@@ -0,0 +1,274 @@
+"""
+A shared store of compiled extensions, so that machines with the same toolchain
+don't all compile the same modules. `cppimport.settings["artifact_store"]` is
+either a directory (for example on a network filesystem), an http(s) URL or an
+`ArtifactStore` instance.
+
+Artifacts are keyed on the toolchain fingerprint, the build configuration and
+the contents of the rendered source, the extra sources and the declared
+dependencies. Headers discovered by the compiler are only known after a build,
+so they are recorded in the artifact's metadata along with their digests and an
+artifact is only used if all of them match the local files.
+"""
+
+import abc
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import urllib.error
+import urllib.request
+from contextlib import suppress
+
+import cppimport
+from cppimport.filepaths import make_absolute
+
+logger = logging.getLogger(__name__)
+
+_METADATA_VERSION = 1
+_CHUNK_SIZE = 1 << 20
+
+
+class ArtifactStore(abc.ABC):
+    """
+    The interface of an artifact store. An artifact consists of the extension
+    binary and a JSON-serializable metadata dict.
+    """
+
+    @abc.abstractmethod
+    def fetch(self, key, dest):
+        """Write the binary stored under `key` to the file `dest` and return the
+        metadata, or return None if there is no such artifact."""
+
+    @abc.abstractmethod
+    def publish(self, key, src, metadata):
+        """Store the binary `src` along with `metadata` under `key`."""
+
+
+class LocalArtifactStore(ArtifactStore):
+    """
+    An artifact store in a directory that may be shared between machines. Each
+    file is written to a temporary file first and then renamed into place, and
+    the metadata is written after the binary, so readers never see a partially
+    written artifact.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+
+    def fetch(self, key, dest):
+        binary_path, metadata_path = self._entry_paths(key)
+        try:
+            with open(metadata_path, "r") as f:
+                metadata = json.load(f)
+            with open(binary_path, "rb") as src, open(dest, "wb") as dst:
+                for chunk in iter(lambda: src.read(_CHUNK_SIZE), b""):
+                    dst.write(chunk)
+        except FileNotFoundError:
+            return None
+        return metadata
+
+    def publish(self, key, src, metadata):
+        binary_path, metadata_path = self._entry_paths(key)
+        entry_dir = os.path.dirname(binary_path)
+        os.makedirs(entry_dir, exist_ok=True)
+        with open(src, "rb") as f:
+            _atomic_write(binary_path, f.read())
+        _atomic_write(metadata_path, json.dumps(metadata).encode("utf-8"))
+
+    def _entry_paths(self, key):
+        entry = os.path.join(self.directory, key[:2], key)
+        return entry + ".bin", entry + ".json"
+
+
+class HTTPArtifactStore(ArtifactStore):
+    """
+    An artifact store served over HTTP. Artifacts are read with `GET` and
+    uploaded with `PUT` requests to `<url>/<key>.bin` and `<url>/<key>.json`,
+    which is supported by most object stores and simple caching servers.
+    """
+
+    def __init__(self, url, timeout=30):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def fetch(self, key, dest):
+        try:
+            metadata = json.loads(self._request("GET", key + ".json"))
+            data = self._request("GET", key + ".bin")
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+        with open(dest, "wb") as f:
+            f.write(data)
+        return metadata
+
+    def publish(self, key, src, metadata):
+        with open(src, "rb") as f:
+            self._request("PUT", key + ".bin", f.read())
+        # The metadata marks the artifact as complete, so it goes last.
+        self._request("PUT", key + ".json", json.dumps(metadata).encode("utf-8"))
+
+    def _request(self, method, name, data=None):
+        request = urllib.request.Request(f"{self.url}/{name}", data=data, method=method)
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return response.read()
+
+
+def get_artifact_store():
+    """Return the store configured in `cppimport.settings["artifact_store"]` or
+    None."""
+    store = cppimport.settings["artifact_store"]
+    if not store:
+        return None
+    if isinstance(store, ArtifactStore):
+        return store
+    if store.startswith(("http://", "https://")):
+        return HTTPArtifactStore(store)
+    return LocalArtifactStore(store)
+
+
+def artifact_key(module_data):
+    """
+    Compute the key of the artifact for a module that has been templated. This
+    covers everything known before compiling: the toolchain, the build
+    configuration and profile and the contents of the rendered source, the extra
+    sources and the declared dependencies.
+    """
+    from cppimport.checksum import _calc_file_digest
+    from cppimport.profiles import get_profile_name
+    from cppimport.toolchain import fingerprint, trailer_components
+
+    profile = get_profile_name(module_data)
+    filedirname = module_data["filedirname"]
+    cfg = module_data["cfg"]
+    # The Python build, its compiler flags, the pybind11 version and the
+    # profile, as recorded in the trailer. The compiler's path and stat
+    # signature are specific to this machine and its version is part of
+    # `fingerprint()`.
+    toolchain = trailer_components(cfg, profile)
+    del toolchain["compiler"]
+    inputs = [module_data["rendered_src_filepath"]] + [
+        make_absolute(filedirname, p)
+        for p in cfg.get("sources", []) + cfg.get("dependencies", [])
+    ]
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(
+        json.dumps(
+            [
+                _METADATA_VERSION,
+                fingerprint(),
+                module_data["ext_name"],
+                cfg,
+                toolchain,
+            ],
+            sort_keys=True,
+            default=str,
+        ).encode("utf-8")
+    )
+    for filepath in inputs:
+        hasher.update(_calc_file_digest(filepath, "blake2b").encode("ascii"))
+    return hasher.hexdigest()
+
+
+def fetch_artifact(store, module_data):
+    """
+    Try to fetch the extension for a templated module from `store` into
+    `module_data["staged_ext_path"]`. The binary is checked against the digest
+    in its metadata and the discovered headers against the local files.
+    Returns True on success.
+    """
+    from cppimport.checksum import _calc_file_digest
+
+    key = module_data["artifact_key"] = artifact_key(module_data)
+    dest = module_data["staged_ext_path"]
+    try:
+        metadata = store.fetch(key, dest)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Failed to fetch artifact {key}: {e}")
+        return False
+    if metadata is None:
+        logger.debug(f"Artifact {key} not found for {module_data['filepath']}")
+        return False
+    if metadata.get("version") != _METADATA_VERSION or _calc_file_digest(
+        dest, "sha256"
+    ) != metadata.get("sha256"):
+        logger.warning(f"Ignoring corrupt artifact {key}")
+        return False
+
+    filedirname = module_data["filedirname"]
+    discovered = []
+    for dep in metadata["discovered_dependencies"]:
+        filepath = make_absolute(filedirname, dep["path"])
+        try:
+            digest = _calc_file_digest(filepath, "blake2b")
+        except OSError:
+            digest = None
+        if digest != dep["digest"]:
+            logger.debug(f"Artifact {key} was built with a different {filepath}")
+            return False
+        discovered.append(filepath)
+
+    module_data["extra_source_filepaths"] = [
+        make_absolute(filedirname, s) for s in module_data["cfg"].get("sources", [])
+    ]
+    module_data["discovered_dependencies"] = discovered
+    module_data["pch_fingerprint"] = metadata.get("pch")
+    logger.info(f"Fetched {module_data['fullname']} from the artifact store.")
+    return True
+
+
+def publish_artifact(store, module_data):
+    """Upload a freshly built extension, which must not carry a checksum trailer
+    yet, to `store`. Failures are logged and otherwise ignored."""
+    from cppimport.checksum import _calc_file_digest
+
+    key = module_data.get("artifact_key") or artifact_key(module_data)
+    ext_path = module_data["staged_ext_path"]
+    filedirname = module_data["filedirname"]
+    metadata = dict(
+        version=_METADATA_VERSION,
+        sha256=_calc_file_digest(ext_path, "sha256"),
+        size=os.path.getsize(ext_path),
+        pch=module_data.get("pch_fingerprint"),
+        discovered_dependencies=[
+            dict(
+                path=_portable_path(p, filedirname),
+                digest=_calc_file_digest(p, "blake2b"),
+            )
+            for p in module_data.get("discovered_dependencies", [])
+        ],
+    )
+    try:
+        store.publish(key, ext_path, metadata)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Failed to publish artifact {key}: {e}")
+        return
+    logger.debug(f"Published {module_data['fullname']} as artifact {key}")
+
+
+def _portable_path(filepath, filedirname):
+    """Paths are stored relative to the module so that they match on machines
+    with the same source layout in a different location."""
+    try:
+        return os.path.relpath(filepath, filedirname)
+    except ValueError:  # On a different drive on Windows.
+        return filepath
+
+
+def _atomic_write(path, data):
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(OSError):
+            os.remove(tmp_path)
+        raise
@@ -1,26 +1,63 @@
 import contextlib
+import contextvars
+import functools
 import io
 import logging
 import os
+import re
 import shutil
+import sys
+import sysconfig
 import tempfile
+import threading
 
 import setuptools
 import setuptools.command.build_ext
 
 import distutils
+import distutils.ccompiler
 import distutils.sysconfig
 
 import cppimport
+from cppimport.checksum import record_files
 from cppimport.filepaths import make_absolute
+from cppimport.object_cache import ObjectCache
+from cppimport.pgo import (
+    data_filepaths,
+    get_mode,
+    get_pgo_dir,
+    pgo_flags,
+    prepare_build_dir,
+)
+from cppimport.precompiled_headers import CPP_SOURCE_EXTS, get_precompiled_header
+from cppimport.profiles import get_profile, get_profile_name, profile_flags
+from cppimport.scheduler import get_scheduler
 
 logger = logging.getLogger(__name__)
 
+# Output of setuptools is captured separately for each build, see
+# `_capture_output`.
+_output_buffer = contextvars.ContextVar("cppimport_output_buffer", default=None)
+_output_lock = threading.Lock()
+_capturing = 0
+
 
 def build_module(module_data):
     _handle_strict_prototypes()
 
-    build_path = tempfile.mkdtemp()
+    pgo_mode = get_mode()
+    if pgo_mode:
+        build_path = prepare_build_dir(module_data)
+        module_data["pgo"] = dict(
+            mode=pgo_mode,
+            # Recorded before the compiler reads the data.
+            data=(
+                record_files(data_filepaths(module_data)) if pgo_mode == "use" else None
+            ),
+        )
+    else:
+        build_path = tempfile.mkdtemp()
+        module_data["pgo"] = None
 
     full_module_name = module_data["fullname"]
     filepath = module_data["filepath"]
@@ -42,7 +79,7 @@ def build_module(module_data):
     ]
 
     ext = ImportCppExt(
-        os.path.dirname(filepath),
+        module_data.get("staged_ext_path", module_data["ext_path"]),
         full_module_name,
         language="c++",
         sources=(
@@ -54,6 +91,10 @@ def build_module(module_data):
         extra_link_args=cfg.get("extra_link_args", []),
         library_dirs=module_data["abs_library_dirs"],
         libraries=cfg.get("libraries", []),
+        parallel=cfg.get("parallel", False),
+        precompiled_headers=cfg.get("precompiled_headers", []),
+        profile=get_profile_name(module_data),
+        pgo=(pgo_mode, get_pgo_dir(module_data)) if pgo_mode else None,
     )
 
     args = [
@@ -71,27 +112,68 @@ def build_module(module_data):
         cmdclass={"build_ext": BuildImportCppExt},
     )
 
-    # Monkey patch in the parallel compiler if requested.
-    # TODO: this will still cause problems if there is multithreaded code
-    # interacting with distutils. Ideally, we'd just subclass CCompiler
-    # instead.
-    if cfg.get("parallel"):
-        old_compile = distutils.ccompiler.CCompiler.compile
-        distutils.ccompiler.CCompiler.compile = _parallel_compile
-
-    f = io.StringIO()
-    with contextlib.redirect_stdout(f):
-        with contextlib.redirect_stderr(f):
-            setuptools.setup(**setuptools_args)
+    with _capture_output() as f:
+        setuptools.setup(**setuptools_args)
     logger.debug(f"Setuptools/compiler output: {f.getvalue()}")
 
-    # Remove the parallel compiler to not corrupt the outside environment.
-    if cfg.get("parallel"):
-        distutils.ccompiler.CCompiler.compile = old_compile
+    module_data["pch_fingerprint"] = ext.pch_fingerprint
+    module_data["discovered_dependencies"] = _filter_system_headers(
+        ext.discovered_dependencies, module_data["filedirname"]
+    )
 
     shutil.rmtree(build_path)
 
 
+class _ThreadOutput:
+    """
+    Stands in for sys.stdout or sys.stderr while modules are being built.
+    Output written by a build goes to the build's buffer and all other output
+    to the original stream. Compile jobs run by the scheduler's worker threads
+    belong to the build that submitted them, as they run in its context.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, s):
+        buffer = _output_buffer.get()
+        return (self.stream if buffer is None else buffer).write(s)
+
+    def flush(self):
+        if _output_buffer.get() is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@contextlib.contextmanager
+def _capture_output():
+    """
+    Capture what the current build writes to sys.stdout and sys.stderr. Unlike
+    `contextlib.redirect_stdout`, this lets several threads build at once.
+    """
+    global _capturing
+    with _output_lock:
+        if _capturing == 0:
+            sys.stdout = _ThreadOutput(sys.stdout)
+            sys.stderr = _ThreadOutput(sys.stderr)
+        _capturing += 1
+    buffer = io.StringIO()
+    token = _output_buffer.set(buffer)
+    try:
+        yield buffer
+    finally:
+        _output_buffer.reset(token)
+        with _output_lock:
+            _capturing -= 1
+            if _capturing == 0:
+                if isinstance(sys.stdout, _ThreadOutput):
+                    sys.stdout = sys.stdout.stream
+                if isinstance(sys.stderr, _ThreadOutput):
+                    sys.stderr = sys.stderr.stream
+
+
 def _handle_strict_prototypes():
     if not cppimport.settings["remove_strict_prototypes"]:
         return
@@ -102,72 +184,261 @@ def _handle_strict_prototypes():
             cfg_vars[key] = value.replace("-Wstrict-prototypes", "")
 
 
+def _filter_system_headers(headers, module_dir):
+    """
+    Drop headers belonging to the Python installation or to installed packages
+    like pybind11. These only change along with the toolchain, so tracking them
+    would only slow down the checksum.
+    """
+    paths = sysconfig.get_paths()
+    system_dirs = [paths[k] for k in ("include", "platinclude", "purelib", "platlib")]
+    with contextlib.suppress(ImportError):
+        import pybind11
+
+        system_dirs += [pybind11.get_include(), pybind11.get_include(True)]
+    system_dirs = [os.path.join(os.path.realpath(d), "") for d in system_dirs]
+    module_dir = os.path.join(os.path.realpath(module_dir), "")
+
+    out = []
+    for header in headers:
+        real_header = os.path.realpath(header)
+        if not real_header.startswith(module_dir) and any(
+            real_header.startswith(d) for d in system_dirs
+        ):
+            continue
+        out.append(header)
+    return out
+
+
+def _read_depfile(depfile_path):
+    """
+    Parse a Makefile-style dependency file as written by `-MMD` and return the
+    list of prerequisites.
+    """
+    with open(depfile_path, "r") as f:
+        text = f.read().replace("\\\n", " ")
+    # The first colon followed by whitespace separates the target from the
+    # prerequisites. Spaces inside filenames are escaped with a backslash.
+    parts = re.split(r":(?:\s|$)", text, maxsplit=1)
+    if len(parts) != 2:
+        return []
+    return [
+        t.replace("\\ ", " ").replace("$$", "$")
+        for t in re.findall(r"(?:\\.|[^\s\\])+", parts[1])
+    ]
+
+
 class ImportCppExt(setuptools.Extension):
     """
-    Subclass setuptools.Extension to add self.libdest specifying where the shared
-    library should be placed after being compiled with BuildImportCppExt.
+    Subclass setuptools.Extension to add self.dest_path specifying where the
+    shared library should be placed after being compiled with BuildImportCppExt.
     """
 
-    def __init__(self, libdest, *args, **kwargs):
-        self.libdest = libdest
+    def __init__(
+        self,
+        dest_path,
+        *args,
+        parallel=False,
+        precompiled_headers=(),
+        profile=None,
+        pgo=None,
+        **kwargs,
+    ):
+        self.dest_path = dest_path
+        self.parallel = parallel
+        self.precompiled_headers = precompiled_headers
+        self.profile = profile
+        self.pgo = pgo
+        if profile:
+            get_profile(profile)  # Fail early for unknown profiles.
+        self.pch_fingerprint = None
+        self.discovered_dependencies = []
         setuptools.Extension.__init__(self, *args, **kwargs)
 
 
 class BuildImportCppExt(setuptools.command.build_ext.build_ext):
     """
     Subclass setuptools build_ext to put the compiled shared library in the
-    appropriate place in the source tree from the ImportCppExt.libdest value.
+    appropriate place in the source tree from the ImportCppExt.dest_path value.
     """
 
+    def build_extension(self, ext):
+        # The profile's flags come first so that those of the module take
+        # precedence.
+        compile_args, link_args = profile_flags(
+            ext.profile, self.compiler.compiler_type
+        )
+        gcc_like = self.compiler.compiler_type in ("unix", "mingw32", "cygwin")
+        if ext.pgo is not None and gcc_like:
+            pgo_mode, pgo_dir = ext.pgo
+            pgo_compile_args, pgo_link_args = pgo_flags(
+                pgo_mode, self.compiler.compiler_so, pgo_dir
+            )
+            compile_args += pgo_compile_args
+            link_args += pgo_link_args
+        elif ext.pgo is not None:
+            logger.warning(
+                "Profile-guided optimization requires a GCC-compatible compiler; "
+                f"building {ext.name} without it."
+            )
+        ext.extra_compile_args = compile_args + ext.extra_compile_args
+        ext.extra_link_args = link_args + ext.extra_link_args
+
+        # GCC-compatible compilers can tell us which headers were included via
+        # a dependency file written next to each object file.
+        write_depfiles = cppimport.settings["discover_dependencies"] and gcc_like
+        if write_depfiles:
+            ext.extra_compile_args = ext.extra_compile_args + ["-MMD"]
+
+        cache_dir = os.path.expanduser(cppimport.settings["cache_dir"])
+        pch_dir = os.path.join(cache_dir, "pch")
+
+        # Compilers that implement `compile` on their own (like MSVC) are left
+        # untouched.
+        if type(self.compiler).compile is distutils.ccompiler.CCompiler.compile:
+            self.compiler.__class__ = _scheduled_compiler_class(type(self.compiler))
+            self.compiler.parallel = ext.parallel
+            # The object cache relies on the GCC-style `-E` flag for
+            # preprocessing. Objects built with profile data depend on more
+            # than their preprocessed source.
+            if (
+                cppimport.settings["object_cache"]
+                and write_depfiles
+                and ext.pgo is None
+            ):
+                self.compiler.object_cache = ObjectCache(
+                    os.path.join(cache_dir, "objects"),
+                    cppimport.settings["object_cache_max_size"],
+                )
+            # Precompiled headers are only supported for GCC-compatible
+            # compilers.
+            if ext.precompiled_headers and write_depfiles:
+                self.compiler.precompiled_headers = ext.precompiled_headers
+                self.compiler.pch_dir = pch_dir
+
+        if ext.pgo is not None:
+            # distutils remembers the directories it created, which doesn't hold
+            # for the build directory of PGO builds that is emptied every time.
+            for obj in self.compiler.object_filenames(
+                ext.sources, output_dir=self.build_temp
+            ):
+                os.makedirs(os.path.dirname(obj), exist_ok=True)
+
+        super().build_extension(ext)
+        ext.pch_fingerprint = getattr(self.compiler, "pch_fingerprint", None)
+        pch_dependencies = getattr(self.compiler, "pch_dependencies", [])
+
+        if write_depfiles:
+            abs_sources = set(os.path.abspath(s) for s in ext.sources)
+            objects = self.compiler.object_filenames(
+                ext.sources, output_dir=self.build_temp
+            )
+            discovered = [os.path.abspath(d) for d in pch_dependencies]
+            for obj in objects:
+                depfile_path = os.path.splitext(obj)[0] + ".d"
+                if not os.path.exists(depfile_path):
+                    continue
+                for dep in _read_depfile(depfile_path):
+                    dep = os.path.abspath(dep)
+                    # The precompiled header wrapper belongs to the cache.
+                    if dep.startswith(os.path.join(pch_dir, "")):
+                        continue
+                    if dep not in abs_sources and dep not in discovered:
+                        discovered.append(dep)
+            ext.discovered_dependencies = discovered
+
     def copy_extensions_to_source(self):
         for ext in self.extensions:
             fullname = self.get_ext_fullname(ext.name)
             filename = self.get_ext_filename(fullname)
             src_filename = os.path.join(self.build_lib, filename)
-            dest_filename = os.path.join(ext.libdest, os.path.basename(filename))
 
             distutils.file_util.copy_file(
-                src_filename, dest_filename, verbose=self.verbose, dry_run=self.dry_run
+                src_filename, ext.dest_path, verbose=self.verbose, dry_run=self.dry_run
             )
 
 
-# Patch for parallel compilation with distutils
-# From: http://stackoverflow.com/questions/11013851/speeding-up-build-process-with-distutils # noqa: E501
-def _parallel_compile(
-    self,
-    sources,
-    output_dir=None,
-    macros=None,
-    include_dirs=None,
-    debug=0,
-    extra_preargs=None,
-    extra_postargs=None,
-    depends=None,
-):
-    # these lines are copied directly from distutils.ccompiler.CCompiler
-    macros, objects, extra_postargs, pp_opts, build = self._setup_compile(
-        output_dir, macros, include_dirs, sources, depends, extra_postargs
-    )
-    cc_args = self._get_cc_args(pp_opts, debug, extra_preargs)
-
-    # Determine the number of compilation threads. Unless there are special
-    # circumstances, this is the number of cores on the machine
-    N = 1
-    try:
-        import multiprocessing
-        import multiprocessing.pool
-
-        N = multiprocessing.cpu_count()
-    except (ImportError, NotImplementedError):
-        pass
+class _ScheduledCompilerMixin:
+    """
+    Mixed into the distutils compiler class chosen by build_ext so that all
+    compiler and linker invocations go through the process-wide compile
+    scheduler. If `parallel` is set, the translation units of an extension are
+    compiled concurrently. If `object_cache` is set, objects are fetched from and
+    stored in the cache.
+    """
 
-    def _single_compile(obj):
-        try:
-            src, ext = build[obj]
-        except KeyError:
+    parallel = False
+    object_cache = None
+    precompiled_headers = ()
+    pch_dir = None
+    pch_fingerprint = None
+    pch_dependencies = ()
+
+    def compile(
+        self,
+        sources,
+        output_dir=None,
+        macros=None,
+        include_dirs=None,
+        debug=0,
+        extra_preargs=None,
+        extra_postargs=None,
+        depends=None,
+    ):
+        # these lines are copied directly from distutils.ccompiler.CCompiler
+        macros, objects, extra_postargs, pp_opts, build = self._setup_compile(
+            output_dir, macros, include_dirs, sources, depends, extra_postargs
+        )
+        cc_args = self._get_cc_args(pp_opts, debug, extra_preargs)
+
+        scheduler = get_scheduler()
+        cpp_postargs = extra_postargs
+        if self.precompiled_headers:
+            pch = scheduler.run(
+                get_precompiled_header,
+                self.compiler_so,
+                list(self.precompiled_headers),
+                cc_args,
+                extra_postargs,
+                self.pch_dir,
+            )
+            wrapper_path, self.pch_fingerprint, self.pch_dependencies = pch
+            if wrapper_path is not None:
+                cpp_postargs = ["-include", wrapper_path] + extra_postargs
+
+        def _single_compile(obj):
+            try:
+                src, ext = build[obj]
+            except KeyError:
+                return
+            postargs = cpp_postargs if ext in CPP_SOURCE_EXTS else extra_postargs
+            self._cached_compile(obj, src, ext, cc_args, postargs, pp_opts)
+
+        if self.parallel:
+            scheduler.map(_single_compile, objects)
+        else:
+            for obj in objects:
+                scheduler.run(_single_compile, obj)
+        return objects
+
+    def link(self, *args, **kwargs):
+        return get_scheduler().run(super().link, *args, **kwargs)
+
+    def _cached_compile(self, obj, src, ext, cc_args, extra_postargs, pp_opts):
+        key = None
+        if self.object_cache is not None:
+            key = self.object_cache.key(self.compiler_so, src, cc_args, extra_postargs)
+        if key is not None and self.object_cache.fetch(key, obj):
             return
         self._compile(obj, src, ext, cc_args, extra_postargs, pp_opts)
+        if key is not None:
+            self.object_cache.store(key, obj)
 
-    # imap is evaluated on demand, converting to list() forces execution
-    list(multiprocessing.pool.ThreadPool(N).imap(_single_compile, objects))
-    return objects
+
+@functools.lru_cache(maxsize=None)
+def _scheduled_compiler_class(compiler_class):
+    return type(
+        "Scheduled" + compiler_class.__name__,
+        (_ScheduledCompilerMixin, compiler_class),
+        {},
+    )
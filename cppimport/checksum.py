@@ -1,12 +1,25 @@
 import hashlib
 import json
 import logging
+import os
+import shutil
 import struct
+import time
 
+import cppimport
 from cppimport.filepaths import make_absolute
+from cppimport.profiles import get_profile_name
+from cppimport.toolchain import changed_components, trailer_components
+from cppimport.trace import phase
 
 _TAG = b"cppimport"
 _FMT = struct.Struct("q" + str(len(_TAG)) + "s")
+_TRAILER_VERSION = 2
+_CHUNK_SIZE = 1 << 20
+# A dependency whose mtime is this close to the time the trailer was written
+# might have been modified again within the filesystem's timestamp resolution,
+# so its stat signature alone is not trusted (the "racy git" problem).
+_RACY_MARGIN_NS = 2 * 10**9
 
 logger = logging.getLogger(__name__)
 
@@ -15,12 +28,29 @@ def is_checksum_valid(module_data):
     """
     Load the saved checksum from the extension file check if it matches the
     checksum computed from current source files.
+
+    Dependencies whose size, mtime and inode are unchanged since the trailer
+    was written are not re-read. The extension is also out of date if the
+    toolchain recorded in the trailer changed, see
+    `cppimport.toolchain.trailer_components`.
     """
-    deps, old_checksum = _load_checksum_trailer(module_data)
-    if old_checksum is None:
+    with phase("checksum", module_data["fullname"]):
+        return _is_checksum_valid(module_data)
+
+
+def _is_checksum_valid(module_data):
+    trailer = _load_checksum_trailer(module_data)
+    if trailer is None:
         return False  # Already logged error in load_checksum_trailer.
     try:
-        return old_checksum == _calc_cur_checksum(deps, module_data)
+        if trailer.get("version") != _TRAILER_VERSION:
+            # Trailers written by older versions of cppimport.
+            return trailer["checksum"] == _calc_legacy_checksum(trailer["deps"])
+        return (
+            _is_toolchain_unchanged(trailer)
+            and _is_pgo_unchanged(module_data, trailer)
+            and _are_deps_unchanged(trailer)
+        )
     except OSError as e:
         logger.info(
             "Checksummed file not found while checking cppimport checksum "
@@ -29,6 +59,50 @@ def is_checksum_valid(module_data):
         return False
 
 
+def _is_toolchain_unchanged(trailer):
+    # Trailers written before the toolchain was recorded aren't checked.
+    changed = changed_components(trailer.get("toolchain") or {})
+    if changed:
+        logger.info(
+            f"The toolchain changed since the extension was built "
+            f"({', '.join(changed)}); rebuilding."
+        )
+    return not changed
+
+
+def _is_pgo_unchanged(module_data, trailer):
+    recorded = trailer.get("pgo") or {}
+    mode = cppimport.settings["pgo"] or None
+    if recorded.get("mode") != mode:
+        logger.info("The PGO mode changed since the extension was built; rebuilding.")
+        return False
+    if mode == "use":
+        from cppimport.pgo import data_filepaths
+
+        # Like dependencies, profile data files are only read if their stat
+        # signature changed.
+        data = recorded.get("data") or []
+        paths = [d["path"] for d in data]
+        if paths != data_filepaths(module_data) or not _are_deps_unchanged(
+            dict(trailer, deps=data)
+        ):
+            logger.info("The PGO profile data changed; rebuilding.")
+            return False
+    return True
+
+
+def _are_deps_unchanged(trailer):
+    hash_name = trailer["hash"]
+    trusted_before = trailer["time_ns"] - _RACY_MARGIN_NS
+    for dep in trailer["deps"]:
+        signature = _stat_signature(dep["path"])
+        if signature == dep["stat"] and signature[1] < trusted_before:
+            continue
+        if _calc_file_digest(dep["path"], hash_name) != dep["digest"]:
+            return False
+    return True
+
+
 def _load_checksum_trailer(module_data):
     try:
         with open(module_data["ext_path"], "rb") as f:
@@ -39,56 +113,204 @@ def _load_checksum_trailer(module_data):
                     "The extension is missing the trailer tag and thus is missing"
                     " its checksum; rebuilding."
                 )
-                return None, None
+                return None
             f.seek(-(_FMT.size + json_len), 2)
             json_s = f.read(json_len)
     except FileNotFoundError:
         logger.info("Failed to find compiled extension; rebuilding.")
-        return None, None
+        return None
     except OSError:
         logger.info("Checksum trailer invalid. Rebuilding.")
-        return None, None
+        return None
 
     try:
-        deps, old_checksum = json.loads(json_s)
+        trailer = json.loads(json_s)
+        if isinstance(trailer, list):
+            deps, old_checksum = trailer
+            trailer = dict(hash="md5", deps=deps, checksum=old_checksum)
     except ValueError:
         logger.info(
             "Failed to load checksum trailer info from already existing "
             "compiled extension; rebuilding."
         )
-        return None, None
-    return deps, old_checksum
+        return None
+    return trailer
 
 
 def checksum_save(module_data):
     """
     Calculate the module checksum and then write it to the end of the shared
-    object.
+    object, or to the end of the staged shared object if there is one.
     """
     dep_filepaths = (
         [
             make_absolute(module_data["filedirname"], d)
             for d in module_data["cfg"].get("dependencies", [])
         ]
+        + module_data.get("discovered_dependencies", [])
         + module_data["extra_source_filepaths"]
         + [module_data["filepath"]]
     )
-    cur_checksum = _calc_cur_checksum(dep_filepaths, module_data)
-    _save_checksum_trailer(module_data, dep_filepaths, cur_checksum)
+    # Headers discovered by the compiler are often also listed by hand.
+    dep_filepaths = list(dict.fromkeys(dep_filepaths))
+    hash_name = cppimport.settings["checksum_hash"]
+    deps = record_files(dep_filepaths)
+    # The precompiled header used for the build is part of the checksum so that
+    # binaries built against different precompiled headers are distinguishable.
+    pch_fingerprint = module_data.get("pch_fingerprint")
+    digests = [d["digest"] for d in deps]
+    if pch_fingerprint is not None:
+        digests.append(pch_fingerprint)
+    # Likewise for the mode and the profile data of PGO builds.
+    pgo = module_data.get("pgo")
+    if pgo is not None:
+        digests += [pgo["mode"]] + [d["digest"] for d in pgo["data"] or []]
+    trailer = dict(
+        version=_TRAILER_VERSION,
+        hash=hash_name,
+        time_ns=time.time_ns(),
+        deps=deps,
+        pch=pch_fingerprint,
+        pgo=pgo,
+        checksum=_calc_combined_digest(digests, hash_name),
+        rendered=_calc_rendered_digest(module_data, hash_name),
+        toolchain=trailer_components(module_data["cfg"], get_profile_name(module_data)),
+    )
+    _save_checksum_trailer(module_data, trailer)
+
+
+def record_files(filepaths):
+    """
+    Return the path, stat signature and digest of each of `filepaths`, as
+    recorded for the dependencies in the checksum trailer.
+    """
+    hash_name = cppimport.settings["checksum_hash"]
+    records = []
+    for filepath in filepaths:
+        # Stat before reading so that a concurrent modification results in a
+        # mismatching signature rather than a stale digest.
+        signature = _stat_signature(filepath)
+        digest = _calc_file_digest(filepath, hash_name)
+        records.append(dict(path=filepath, stat=signature, digest=digest))
+    return records
+
+
+def is_rendered_source_unchanged(module_data):
+    """
+    Check whether the existing extension of a freshly templated module was
+    built from the same rendered source and configuration and whether all of
+    its other dependencies are unchanged. This is the case after edits that
+    only affect the template, e.g. to whitespace in a `<% %>` block.
+
+    If so, the module data is set up like after a build, so that
+    `checksum_save` records the same dependencies as the existing trailer.
+    """
+    if not os.path.exists(module_data["ext_path"]):
+        return False
+    trailer = _load_checksum_trailer(module_data)
+    if (
+        trailer is None
+        or trailer.get("version") != _TRAILER_VERSION
+        or trailer.get("rendered") is None
+    ):
+        return False
+    other_deps = [d for d in trailer["deps"] if d["path"] != module_data["filepath"]]
+    try:
+        if (
+            _calc_rendered_digest(module_data, trailer["hash"]) != trailer["rendered"]
+            or not _is_toolchain_unchanged(trailer)
+            or not _is_pgo_unchanged(module_data, trailer)
+            or not _are_deps_unchanged(dict(trailer, deps=other_deps))
+        ):
+            return False
+    except OSError:
+        return False
 
+    module_data["extra_source_filepaths"] = [
+        make_absolute(module_data["filedirname"], s)
+        for s in module_data["cfg"].get("sources", [])
+    ]
+    module_data["discovered_dependencies"] = [d["path"] for d in other_deps]
+    module_data["pch_fingerprint"] = trailer["pch"]
+    module_data["pgo"] = trailer.get("pgo")
+    return True
 
-def _save_checksum_trailer(module_data, dep_filepaths, cur_checksum):
+
+def copy_without_trailer(src, dst):
+    """Copy the extension `src` without its checksum trailer to `dst`."""
+    with open(src, "rb") as f:
+        f.seek(-_FMT.size, 2)
+        json_len, tag = _FMT.unpack(f.read(_FMT.size))
+        if tag != _TAG:
+            raise ValueError(f"{src} has no checksum trailer")
+        remaining = f.tell() - _FMT.size - json_len
+        f.seek(0)
+        with open(dst, "wb") as out:
+            while remaining > 0:
+                chunk = f.read(min(_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ValueError(f"{src} is truncated")
+                out.write(chunk)
+                remaining -= len(chunk)
+    shutil.copymode(src, dst)
+
+
+def _save_checksum_trailer(module_data, trailer):
     # We can just append the checksum to the shared object; this is effectively
     # legal (see e.g. https://stackoverflow.com/questions/10106447).
-    dump = json.dumps([dep_filepaths, cur_checksum]).encode("ascii")
+    dump = json.dumps(trailer).encode("ascii")
     dump += _FMT.pack(len(dump), _TAG)
-    with open(module_data["ext_path"], "ab", buffering=0) as file:
+    ext_path = module_data.get("staged_ext_path", module_data["ext_path"])
+    with open(ext_path, "ab", buffering=0) as file:
         file.write(dump)
 
 
-def _calc_cur_checksum(file_lst, module_data):
-    text = b""
+def _stat_signature(filepath):
+    st = os.stat(filepath)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def _new_hasher(hash_name):
+    if hash_name.startswith("xxh"):
+        import xxhash
+
+        return getattr(xxhash, hash_name)()
+    return hashlib.new(hash_name)
+
+
+def _calc_file_digest(filepath, hash_name):
+    hasher = _new_hasher(hash_name)
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _calc_rendered_digest(module_data, hash_name):
+    """The digest of the rendered source together with the configuration."""
+    hasher = _new_hasher(hash_name)
+    hasher.update(
+        json.dumps(module_data["cfg"], sort_keys=True, default=str).encode("utf-8")
+    )
+    hasher.update(
+        _calc_file_digest(module_data["rendered_src_filepath"], hash_name).encode(
+            "ascii"
+        )
+    )
+    return hasher.hexdigest()
+
+
+def _calc_combined_digest(digests, hash_name):
+    hasher = _new_hasher(hash_name)
+    for digest in digests:
+        hasher.update(digest.encode("ascii"))
+    return hasher.hexdigest()
+
+
+def _calc_legacy_checksum(file_lst):
+    hasher = hashlib.md5()
     for filepath in file_lst:
         with open(filepath, "rb") as f:
-            text += f.read()
-    return hashlib.md5(text).hexdigest()
+            for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+    return hasher.hexdigest()
@@ -0,0 +1,222 @@
+"""
+An optional build daemon, started with `python -m cppimport serve`. It listens
+on a Unix socket and builds modules on behalf of client processes, so that the
+clients don't need to import the build toolchain or run their own compilers.
+Concurrent requests for the same module are merged into a single build and the
+number of modules built at the same time is limited.
+
+The protocol is a single line of JSON in each direction: the client sends the
+module to build and the daemon replies with `{"ok": true}` once the extension
+is up to date or with `{"ok": false, "error": ...}`.
+"""
+
+import concurrent.futures
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from time import time
+
+import cppimport
+
+logger = logging.getLogger(__name__)
+
+# Settings that change the extension or its checksum trailer. The daemon only
+# builds for clients using the same values as itself.
+_BUILD_SETTINGS = ("pgo", "checksum_hash", "discover_dependencies", "pybind11_pch")
+
+
+def get_socket_path():
+    """The socket set in `cppimport.settings["daemon_socket"]` or, by default,
+    `daemon.sock` in the cache directory."""
+    socket_path = cppimport.settings["daemon_socket"]
+    if not socket_path:
+        socket_path = os.path.join(cppimport.settings["cache_dir"], "daemon.sock")
+    return os.path.expanduser(socket_path)
+
+
+def request_build(module_data):
+    """
+    Ask a running build daemon to build the module. Returns True once the
+    daemon has built it and False if no daemon is running or the build failed,
+    in which case the caller builds the module itself.
+    """
+    socket_path = get_socket_path()
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(socket_path):
+        return False
+    from cppimport.toolchain import build_variant
+
+    request = dict(
+        fullname=module_data["fullname"],
+        filepath=module_data["filepath"],
+        ext_path=module_data["ext_path"],
+        build_dir=module_data["build_dir"],
+        build_profile=module_data["build_profile"],
+        build_variant=build_variant(),
+        settings=_build_settings(),
+    )
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(cppimport.settings["lock_timeout"])
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as f:
+                response = json.loads(f.readline())
+    except (OSError, ValueError) as e:
+        logger.debug(f"Build daemon at {socket_path} is not available: {e}")
+        return False
+    if not response["ok"]:
+        logger.warning(
+            f"The build daemon failed to build {module_data['fullname']}, "
+            f"building it in this process instead: {response['error']}"
+        )
+        return False
+    logger.debug(f"Build daemon built {module_data['fullname']}")
+    return True
+
+
+def serve(socket_path=None, jobs=None):
+    """
+    Run a build daemon listening on `socket_path` (by default, see
+    `get_socket_path`) until interrupted. At most `jobs` modules are built at
+    the same time, by default `cppimport.settings["jobs"]`.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        raise RuntimeError("The build daemon requires Unix domain sockets.")
+    if socket_path is None:
+        socket_path = get_socket_path()
+    if jobs is not None:
+        cppimport.settings["jobs"] = jobs
+    # The daemon mustn't send builds to itself.
+    cppimport.settings["use_daemon"] = False
+
+    if os.path.exists(socket_path):
+        if _is_listening(socket_path):
+            raise RuntimeError(f"A build daemon is already running at {socket_path}")
+        os.remove(socket_path)
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+
+    # Only the current user may connect.
+    old_umask = os.umask(0o177)
+    try:
+        server = BuildServer(socket_path)
+    finally:
+        os.umask(old_umask)
+    logger.info(
+        f"Build daemon listening on {socket_path}, building up to "
+        f"{server.max_jobs} modules at a time."
+    )
+    if threading.current_thread() is threading.main_thread():
+        # Remove the socket when stopped with e.g. `kill`, too.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def _is_listening(socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+# Unix sockets aren't available on Windows.
+_UnixServer = getattr(socketserver, "ThreadingUnixStreamServer", object)
+
+
+class BuildServer(_UnixServer):
+    """
+    Handles each connection in its own thread and runs the builds in a pool of
+    `max_jobs` threads. A request for an extension that is already being built
+    waits for that build instead of starting another one.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        super().__init__(socket_path, _RequestHandler)
+        self.max_jobs = cppimport.settings["jobs"] or os.cpu_count() or 1
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_jobs, thread_name_prefix="cppimport-daemon"
+        )
+        # Maps the path of an extension to the future of its build in progress.
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+    def submit(self, request):
+        key = request["ext_path"]
+        with self._pending_lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = self._executor.submit(_build, request)
+                future.add_done_callback(lambda f: self._forget(key, f))
+        return future
+
+    def _forget(self, key, future):
+        with self._pending_lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=True)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        from cppimport.toolchain import build_variant
+
+        try:
+            request = json.loads(self.rfile.readline())
+            if request["build_variant"] != build_variant():
+                raise ValueError(
+                    "the client uses a different Python ABI, compiler or "
+                    "compiler flags than the daemon"
+                )
+            if request["settings"] != _build_settings():
+                raise ValueError(
+                    "the client uses different build settings than the daemon: "
+                    + ", ".join(
+                        k
+                        for k, v in _build_settings().items()
+                        if request["settings"].get(k) != v
+                    )
+                )
+            self.server.submit(request).result()
+            response = dict(ok=True)
+        # setuptools reports compilation errors by raising SystemExit.
+        except (Exception, SystemExit) as e:
+            logger.error(f"Failed to handle build request: {e!r}")
+            response = dict(ok=False, error=repr(e))
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+def _build_settings():
+    return {k: cppimport.settings[k] or None for k in _BUILD_SETTINGS}
+
+
+def _build(request):
+    from cppimport.checksum import is_checksum_valid
+    from cppimport.importer import build_safely, setup_module_data
+
+    module_data = setup_module_data(request["fullname"], request["filepath"])
+    module_data["ext_path"] = request["ext_path"]
+    module_data["build_dir"] = request["build_dir"]
+    module_data["build_profile"] = request["build_profile"]
+    # An earlier request may already have built the module.
+    if os.path.exists(module_data["ext_path"]) and is_checksum_valid(module_data):
+        return
+    t = time()
+    build_safely(module_data["filepath"], module_data)
+    logger.info(f"Built {module_data['fullname']} in {time() - t:.1f}s")
@@ -4,12 +4,27 @@ import sys
 
 import cppimport
 from cppimport.filepaths import make_absolute
+from cppimport.trace import phase
 
 logger = logging.getLogger(__name__)
 
+# Maps a directory to (mtime_ns, file_exts, candidate source names, subdirectory
+# names). Like importlib's FileFinder, an entry is refreshed whenever the
+# directory's mtime changes and is dropped by `invalidate_caches`.
+_dir_index = {}
+
+
+def invalidate_caches():
+    """
+    Forget all cached directory listings. This is called by
+    `importlib.invalidate_caches` when the import hook is installed.
+    """
+    _dir_index.clear()
+
 
 def find_module_cpppath(modulename, opt_in=False):
-    filepath = _find_module_cpppath(modulename, opt_in)
+    with phase("find", modulename):
+        filepath = _find_module_cpppath(modulename, opt_in)
     if filepath is None:
         raise ImportError(
             "Couldn't find a file matching the module name: "
@@ -21,64 +36,123 @@ def find_module_cpppath(modulename, opt_in=False):
     return filepath
 
 
-def _find_module_cpppath(modulename, opt_in=False):
+def _find_module_cpppath(modulename, opt_in=False, searched=None):
+    """
+    Return the path of the source file of `modulename` or None. If `searched`
+    is a list, a (path, mtime_ns) pair is appended to it for every directory
+    listing and skipped file the result depends on, see `is_search_unchanged`.
+    """
     modulepath_without_ext = modulename.replace(".", os.sep)
     moduledir = os.path.dirname(modulepath_without_ext + ".throwaway")
-    matching_dirs = _find_matching_path_dirs(moduledir)
+    matching_dirs = _find_matching_path_dirs(moduledir, searched)
     abs_matching_dirs = _make_dirs_absolute(matching_dirs)
 
     for ext in cppimport.settings["file_exts"]:
         modulefilename = os.path.basename(modulepath_without_ext + ext)
-        outfilename = _find_file_in_folders(modulefilename, abs_matching_dirs, opt_in)
+        outfilename = _find_file_in_folders(
+            modulefilename, abs_matching_dirs, opt_in, searched
+        )
         if outfilename is not None:
             return outfilename
 
     return None
 
 
+def is_search_unchanged(searched):
+    """
+    Whether none of the directories and files recorded by `_find_module_cpppath`
+    in `searched` changed since, so that the search would give the same result.
+    """
+    return all(_try_mtime(path) == mtime for path, mtime in searched)
+
+
+def _try_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
 def _make_dirs_absolute(dirs):
+    cwd = os.getcwd()
     out = []
     for d in dirs:
         if d == "":
-            d = os.getcwd()
-        out.append(make_absolute(os.getcwd(), d))
+            d = cwd
+        out.append(make_absolute(cwd, d))
     return out
 
 
-def _find_matching_path_dirs(moduledir):
+def _find_matching_path_dirs(moduledir, searched=None):
     if moduledir == "":
         return sys.path
 
+    parts = moduledir.split(os.sep)
     ds = []
-    for dir in sys.path:
-        test_path = os.path.join(dir, moduledir)
-        if os.path.exists(test_path) and os.path.isdir(test_path):
+    for dir in _make_dirs_absolute(sys.path):
+        test_path = dir
+        for part in parts:
+            if part not in _get_dir_index(test_path, searched)[3]:
+                break
+            test_path = os.path.join(test_path, part)
+        else:
             ds.append(test_path)
     return ds
 
 
-def _find_file_in_folders(filename, paths, opt_in):
+def _find_file_in_folders(filename, paths, opt_in, searched=None):
     for d in paths:
-        if not os.path.exists(d):
+        if filename not in _get_dir_index(d, searched)[2]:
             continue
 
-        if os.path.isfile(d):
+        filepath = os.path.join(d, filename)
+        if opt_in and not _check_first_line_contains_cppimport(filepath):
+            logger.debug(
+                "Found file but the first line doesn't "
+                "contain cppimport so it will be skipped: " + filepath
+            )
+            if searched is not None:
+                searched.append((filepath, _try_mtime(filepath)))
             continue
-
-        for f in os.listdir(d):
-            if f != filename:
-                continue
-            filepath = os.path.join(d, f)
-            if opt_in and not _check_first_line_contains_cppimport(filepath):
-                logger.debug(
-                    "Found file but the first line doesn't "
-                    "contain cppimport so it will be skipped: " + filepath
-                )
-                continue
-            return filepath
+        return filepath
     return None
 
 
+def _get_dir_index(d, searched=None):
+    """
+    Return the cached index entry for directory `d`, rescanning the directory
+    only if its mtime or the configured file extensions changed. Paths that
+    don't exist or aren't directories produce an empty index.
+    """
+    file_exts = tuple(cppimport.settings["file_exts"])
+    mtime = _try_mtime(d)
+    if searched is not None:
+        searched.append((d, mtime))
+
+    entry = _dir_index.get(d)
+    if entry is not None and entry[0] == mtime and entry[1] == file_exts:
+        return entry
+
+    candidates = set()
+    subdirs = set()
+    if mtime is not None:
+        try:
+            with os.scandir(d) as it:
+                for dir_entry in it:
+                    if os.path.splitext(dir_entry.name)[1] in file_exts:
+                        candidates.add(dir_entry.name)
+                    try:
+                        if dir_entry.is_dir():
+                            subdirs.add(dir_entry.name)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+    entry = (mtime, file_exts, frozenset(candidates), frozenset(subdirs))
+    _dir_index[d] = entry
+    return entry
+
+
 def _check_first_line_contains_cppimport(filepath):
     with open(filepath, "rb") as f:
         return b"cppimport" in f.readline()
@@ -1,30 +1,185 @@
+import importlib.machinery
+import importlib.util
 import logging
 import sys
-import traceback
+import threading
+import types
 
 import cppimport
+import cppimport.find
+import cppimport.manifest
+import cppimport.trace
 
 logger = logging.getLogger(__name__)
 
 
 class Hook(object):
     def __init__(self):
-        self._running = False
+        # Maps names that we already know are not C/C++ modules to the
+        # directories and files the search looked at, with their mtimes. An
+        # entry only holds while none of them changed, so sources created at
+        # runtime are found. The cache is only valid for a particular sys.path
+        # and is dropped by invalidate_caches().
+        self._not_found = {}
+        self._not_found_sys_path = None
+        self._lock = threading.Lock()
 
     def find_spec(self, fullname, path, target=None):
-        # Prevent re-entry by the underlying importer
-        if self._running:
+        if self._is_known_non_cpp(fullname):
+            return None
+
+        # A prebuilt module listed in the manifest doesn't need to be searched
+        # for.
+        module_data = cppimport.manifest.lookup_module_data(fullname)
+        if module_data is None:
+            searched = []
+            with cppimport.trace.phase("find", fullname):
+                filepath = cppimport.find._find_module_cpppath(
+                    fullname, opt_in=True, searched=searched
+                )
+            if filepath is None:
+                self._not_found[fullname] = searched
+                return None
+
+            from cppimport.importer import setup_module_data
+
+            module_data = setup_module_data(fullname, filepath)
+
+        loader = CppImportLoader(module_data)
+        return importlib.util.spec_from_file_location(
+            fullname, module_data["ext_path"], loader=loader
+        )
+
+    def _is_known_non_cpp(self, fullname):
+        if self._not_found_sys_path != sys.path:
+            with self._lock:
+                self._not_found = {}
+                self._not_found_sys_path = list(sys.path)
+        searched = self._not_found.get(fullname)
+        if searched is not None and cppimport.find.is_search_unchanged(searched):
+            return True
+        if (
+            fullname in sys.builtin_module_names
+            or importlib.machinery.FrozenImporter.find_spec(fullname) is not None
+        ):
+            self._not_found[fullname] = []
+            return True
+        return False
+
+    def invalidate_caches(self):
+        # Called by importlib.invalidate_caches()
+        self._not_found = {}
+        cppimport.find.invalidate_caches()
+
+
+class CppImportLoader(importlib.machinery.ExtensionFileLoader):
+    """
+    Loader returned by the import hook. The C/C++ extension is built if needed
+    and then loaded exactly like any other extension module from
+    `module_data["ext_path"]`.
+
+    If `cppimport.settings["lazy"]` is set, the import instead returns a
+    placeholder module and the extension is only built and loaded once an
+    attribute of the module is first accessed, like with
+    `importlib.util.LazyLoader`.
+    """
+
+    def __init__(self, module_data):
+        super().__init__(module_data["fullname"], module_data["ext_path"])
+        self.module_data = module_data
+        self.lazy = cppimport.settings["lazy"]
+
+    def create_module(self, spec):
+        if self.lazy:
+            # Use the default module creation for the placeholder.
+            return None
+
+        from cppimport.importer import build_safely, is_build_needed
+
+        filepath = self.module_data["filepath"]
+        if is_build_needed(self.module_data):
+            build_safely(filepath, self.module_data)
+            return self._load(spec)
+
+        # See the comment in cppimport.imp_from_filepath for why a failed load
+        # triggers a rebuild.
+        try:
+            return self._load(spec)
+        except ImportError as e:
+            logger.info(
+                f"ImportError during import with matching checksum: {e}. "
+                "Trying to rebuild."
+            )
+        build_safely(filepath, self.module_data)
+        return self._load(spec)
+
+    def _load(self, spec):
+        from cppimport.importer import rtld_flags
+
+        with cppimport.trace.phase("load", self.name), rtld_flags():
+            return super().create_module(spec)
+
+    def exec_module(self, module):
+        if self.lazy:
+            module.__class__ = _LazyModule
             return
+        super().exec_module(module)
+
+
+class _LazyModule(types.ModuleType):
+    """A placeholder module that builds and loads its extension on first
+    attribute access."""
+
+    def __getattribute__(self, attr):
+        if attr in _IMPORT_ATTRS:
+            return super().__getattribute__(attr)
+        _load_lazy_module(self)
+        return getattr(self, attr)
+
+    def __delattr__(self, attr):
+        _load_lazy_module(self)
+        delattr(self, attr)
+
+
+# Attributes that the import system reads from modules in sys.modules, for
+# example on every repeated import and in importlib.reload(). The placeholder
+# answers them itself, as their values don't change when the extension loads.
+_IMPORT_ATTRS = frozenset(
+    (
+        "__class__",
+        "__file__",
+        "__loader__",
+        "__name__",
+        "__package__",
+        "__path__",
+        "__spec__",
+    )
+)
+
+_lazy_lock = threading.RLock()
+
 
+def _load_lazy_module(placeholder):
+    with _lazy_lock:
+        if type(placeholder) is not _LazyModule:
+            return  # Loaded by another thread in the meantime.
+        # Plain attribute lookup would trigger another load.
+        spec = object.__getattribute__(placeholder, "__spec__")
+        spec.loader.lazy = False
         try:
-            self._running = True
-            cppimport.imp(fullname, opt_in=True)
-        except ImportError:
-            # ImportError should be quashed because that simply means cppimport
-            # didn't find anything, and probably shouldn't have found anything!
-            logger.debug(traceback.format_exc())
-        finally:
-            self._running = False
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        except BaseException:
+            spec.loader.lazy = True
+            raise
+        # References to the placeholder, for example from `import foo`, keep
+        # working while the import system now hands out the extension module.
+        for key, value in module.__dict__.items():
+            if key not in ("__spec__", "__loader__"):
+                setattr(placeholder, key, value)
+        if sys.modules.get(spec.name) is placeholder:
+            sys.modules[spec.name] = module
+        placeholder.__class__ = types.ModuleType
 
 
 # Add the hook to the list of import handlers for Python.
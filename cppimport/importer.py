@@ -1,85 +1,236 @@
+import hashlib
 import importlib
+import importlib.machinery
+import importlib.util
 import logging
 import os
 import sys
 import sysconfig
-from contextlib import suppress
-from time import sleep, time
-
-import filelock
+import threading
+from contextlib import contextmanager, suppress
+from time import time
 
 import cppimport
-from cppimport.build_module import build_module
-from cppimport.checksum import checksum_save, is_checksum_valid
-from cppimport.templating import run_templating
+from cppimport.checksum import (
+    checksum_save,
+    copy_without_trailer,
+    is_checksum_valid,
+    is_rendered_source_unchanged,
+)
+from cppimport.trace import phase
 
 logger = logging.getLogger(__name__)
 
+# How long to try to obtain the build lock before waiting for the current
+# holder to release it, in seconds.
+_LOCK_ATTEMPT_TIMEOUT = 0.05
 
-class add_to_sys_path:
-    """A Context Manager to temporary add a path to sys.path"""
+# Maps the path of an extension to the lock held by the thread building it.
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
 
-    def __init__(self, path):
-        self.path = path
 
-    def __enter__(self):
-        sys.path.insert(0, self.path)
+def build_safely(filepath, module_data):
+    """Protect against race conditions when multiple processes or threads are
+    executing `template_and_build`"""
+    binary_path = module_data["ext_path"]
+    # Threads of this process building the same module wait for each other
+    # before racing other processes for the file lock.
+    thread_lock = _get_thread_lock(binary_path)
+    waited = not thread_lock.acquire(blocking=False)
+    if waited:
+        thread_lock.acquire()
+    try:
+        if (
+            waited
+            and not cppimport.settings["force_rebuild"]
+            and os.path.exists(binary_path)
+            and is_checksum_valid(module_data)
+        ):
+            return
+        if _build_with_daemon(module_data):
+            return
+        _build_with_file_lock(filepath, module_data)
+    finally:
+        thread_lock.release()
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        try:
-            sys.path.remove(self.path)
-        except ValueError:
-            pass
 
+def _build_with_daemon(module_data):
+    if (
+        not cppimport.settings["use_daemon"]
+        or cppimport.settings["force_rebuild"]
+        # The daemon builds with its own PGO settings.
+        or cppimport.settings["pgo"]
+    ):
+        return False
+    from cppimport.daemon import request_build
 
-def build_safely(filepath, module_data):
-    """Protect against race conditions when multiple processes executing
-    `template_and_build`"""
+    return request_build(module_data)
+
+
+def _get_thread_lock(binary_path):
+    with _thread_locks_lock:
+        return _thread_locks.setdefault(binary_path, threading.Lock())
+
+
+def _build_with_file_lock(filepath, module_data):
     binary_path = module_data["ext_path"]
     lock_path = binary_path + cppimport.settings["lock_suffix"]
+    os.makedirs(os.path.dirname(binary_path), exist_ok=True)
 
-    def build_completed():
-        return os.path.exists(binary_path) and is_checksum_valid(module_data)
+    if not cppimport.settings["use_filelock"]:
+        template_and_build(filepath, module_data)
+        return
 
-    t = time()
+    import filelock
 
-    if cppimport.settings["use_filelock"]:
-        # Race to obtain the lock and build. Other processes can wait
-        while not build_completed() and time() - t < cppimport.settings["lock_timeout"]:
+    force_rebuild = cppimport.settings["force_rebuild"]
+    deadline = time() + cppimport.settings["lock_timeout"]
+    lock = filelock.FileLock(lock_path)
+    # Race to obtain the lock and build. Other processes sleep until the
+    # builder releases the lock and then check once whether the extension is
+    # up to date. Only if the build failed do they race for the lock again.
+    with phase("lock", module_data["fullname"]):
+        while True:
             try:
-                with filelock.FileLock(lock_path, timeout=1):
-                    if build_completed():
-                        break
-                    template_and_build(filepath, module_data)
+                lock.acquire(timeout=1 if force_rebuild else _LOCK_ATTEMPT_TIMEOUT)
+                break
             except filelock.Timeout:
-                logging.debug(f"Could not obtain lock (pid {os.getpid()})")
-                if cppimport.settings["force_rebuild"]:
+                logger.debug(f"Could not obtain lock (pid {os.getpid()})")
+                if force_rebuild:
                     raise ValueError(
                         "force_build must be False to build concurrently."
                         "This process failed to claim a filelock indicating that"
                         " a concurrent build is in progress"
                     )
-                sleep(1)
+            if not _wait_for_lock_release(lock_path, deadline - time()):
+                raise Exception(
+                    f"Could not compile binary as lock already taken and timed out."
+                    f" Try increasing the timeout setting if "
+                    f"the build time is longer (pid {os.getpid()})."
+                )
+            if os.path.exists(binary_path) and is_checksum_valid(module_data):
+                return
 
-        if os.path.exists(lock_path):
-            with suppress(OSError):
-                os.remove(lock_path)
+    try:
+        if force_rebuild or not (
+            os.path.exists(binary_path) and is_checksum_valid(module_data)
+        ):
+            template_and_build(filepath, module_data)
+    finally:
+        lock.release()
+        with suppress(OSError):
+            os.remove(lock_path)
 
-        if not build_completed():
-            raise Exception(
-                f"Could not compile binary as lock already taken and timed out."
-                f" Try increasing the timeout setting if "
-                f"the build time is longer (pid {os.getpid()})."
-            )
-    else:
-        template_and_build(filepath, module_data)
+
+def _wait_for_lock_release(lock_path, timeout):
+    """
+    Block until the process holding the lock at `lock_path` releases it.
+    Returns False if the lock is still held after `timeout` seconds.
+
+    Where `flock` is available, a thread blocks on a shared lock of the file so
+    that the kernel wakes it up as soon as the builder is done. Elsewhere, the
+    lock is polled.
+    """
+    if timeout <= 0:
+        return False
+    try:
+        import fcntl
+    except ImportError:
+        import filelock
+
+        try:
+            with filelock.FileLock(lock_path, timeout=timeout):
+                return True
+        except filelock.Timeout:
+            return False
+
+    try:
+        fd = os.open(lock_path, os.O_RDONLY)
+    except FileNotFoundError:
+        return True  # The builder has already released and removed the lock.
+    released = threading.Event()
+
+    def wait():
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        except OSError:
+            pass  # Locking isn't supported, fall back to polling the lock.
+        finally:
+            os.close(fd)
+            released.set()
+
+    # On a timeout, the thread is left waiting for the lock to be released.
+    threading.Thread(target=wait, daemon=True).start()
+    return released.wait(timeout)
 
 
 def template_and_build(filepath, module_data):
-    logger.debug(f"Compiling {filepath}.")
-    run_templating(module_data)
-    build_module(module_data)
-    checksum_save(module_data)
+    # The build toolchain is imported only once a build is actually needed, so
+    # that loading an up-to-date extension stays cheap.
+    from cppimport.artifact_store import (
+        fetch_artifact,
+        get_artifact_store,
+        publish_artifact,
+    )
+    from cppimport.build_module import build_module
+    from cppimport.profiles import get_profile_name, is_portable
+    from cppimport.templating import run_templating
+
+    fullname = module_data["fullname"]
+    with phase("templating", fullname):
+        run_templating(module_data)
+    # The new extension is staged next to the final path and only moved into
+    # place once complete, so concurrent loaders never see a partial file.
+    module_data["staged_ext_path"] = _staging_path(module_data["ext_path"])
+    try:
+        store = get_artifact_store()
+        # Native and PGO builds are specific to this machine.
+        if store is not None and (
+            not is_portable(get_profile_name(module_data)) or cppimport.settings["pgo"]
+        ):
+            store = None
+        if not cppimport.settings["force_rebuild"] and is_rendered_source_unchanged(
+            module_data
+        ):
+            # Only the template changed, so the extension is reused and just
+            # gets a new trailer.
+            logger.info(f"Rendered source of {filepath} is unchanged; not compiling.")
+            copy_without_trailer(
+                module_data["ext_path"], module_data["staged_ext_path"]
+            )
+        elif store is None or not fetch_artifact(store, module_data):
+            logger.debug(f"Compiling {filepath}.")
+            with phase("build", fullname):
+                build_module(module_data)
+            if store is not None:
+                publish_artifact(store, module_data)
+        with phase("trailer", fullname):
+            checksum_save(module_data)
+            _replace_durably(module_data["staged_ext_path"], module_data["ext_path"])
+    finally:
+        with suppress(OSError):
+            os.remove(module_data.pop("staged_ext_path"))
+
+
+def _staging_path(path):
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, f".{basename}.{os.getpid()}.{threading.get_ident()}")
+
+
+def _replace_durably(src, dst):
+    """Flush `src` to disk and then atomically rename it to `dst`."""
+    with open(src, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(src, dst)
+    # Make the rename itself durable.
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(os.path.dirname(dst), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
 
 def setup_module_data(fullname, filepath):
@@ -88,13 +239,48 @@ def setup_module_data(fullname, filepath):
     module_data["filepath"] = filepath
     module_data["filedirname"] = os.path.dirname(module_data["filepath"])
     module_data["filebasename"] = os.path.basename(module_data["filepath"])
-    module_data["ext_name"] = get_module_name(fullname) + get_extension_suffix()
+    # Extensions built with different profiles or PGO modes live side by side.
+    module_data["build_profile"] = profile = cppimport.settings["build_profile"]
+    pgo_mode = cppimport.settings["pgo"]
+    module_data["ext_name"] = (
+        get_module_name(fullname)
+        + (f".{profile}" if profile else "")
+        + (f".pgo-{pgo_mode}" if pgo_mode else "")
+        + get_extension_suffix()
+    )
+    module_data["build_dir"] = get_build_dir(filepath)
     module_data["ext_path"] = os.path.join(
-        os.path.dirname(filepath), module_data["ext_name"]
+        module_data["build_dir"], module_data["ext_name"]
     )
     return module_data
 
 
+def get_build_dir(filepath):
+    """
+    The directory that the extension and the rendered source are written to.
+    By default, this is the directory of the source file. If
+    `cppimport.settings["build_dir"]` is set, artifacts are instead stored
+    outside of the source tree in a separate directory for each source file and
+    build variant (Python ABI, compiler and compiler flags) so that extensions
+    for different interpreters and compilers can coexist.
+
+    The directory only depends on the path of the source file and not on the
+    module name, which differs between e.g. `build_all` (relative to the
+    directory being built) and imports (relative to the sys.path entry).
+    """
+    build_root = cppimport.settings["build_dir"]
+    if not build_root:
+        return os.path.dirname(filepath)
+    from cppimport.toolchain import build_variant
+
+    filepath = os.path.abspath(filepath)
+    path_hash = hashlib.blake2b(filepath.encode("utf-8"), digest_size=6).hexdigest()
+    stem = os.path.splitext(os.path.basename(filepath))[0]
+    return os.path.join(
+        os.path.expanduser(build_root), f"{stem}-{path_hash}", build_variant()
+    )
+
+
 def get_module_name(full_module_name):
     return full_module_name.split(".")[-1]
 
@@ -106,24 +292,54 @@ def get_extension_suffix():
     return ext_suffix
 
 
+@contextmanager
+def rtld_flags():
+    """Temporarily add cppimport.settings["rtld_flags"] to the dlopen flags."""
+    if not hasattr(sys, "getdlopenflags"):
+        yield
+        return
+    # It can be useful to set rtld_flags to RTLD_GLOBAL. This allows
+    # extensions that are loaded later to share the symbols from this
+    # extension. This is primarily useful in a project where several
+    # interdependent extensions are loaded but it's undesirable to combine
+    # the multiple extensions into a single extension.
+    old_flags = sys.getdlopenflags()
+    sys.setdlopenflags(old_flags | cppimport.settings["rtld_flags"])
+    try:
+        yield
+    finally:
+        sys.setdlopenflags(old_flags)
+
+
 def _actually_load_module(module_data):
-    with add_to_sys_path(module_data["filedirname"]):
-        module_data["module"] = importlib.import_module(module_data["fullname"])
+    fullname = module_data["fullname"]
+    parent, _, child = fullname.rpartition(".")
+    if parent:
+        # Like a regular import, make sure the parent package is imported so
+        # that the extension ends up as an attribute of it.
+        with suppress(ImportError):
+            importlib.import_module(parent)
+    module = sys.modules.get(fullname)
+    if module is None:
+        # Load the extension directly from its path rather than searching
+        # sys.path for it.
+        ext_path = module_data["ext_path"]
+        loader = importlib.machinery.ExtensionFileLoader(fullname, ext_path)
+        spec = importlib.util.spec_from_file_location(fullname, ext_path, loader=loader)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[fullname] = module
+        try:
+            loader.exec_module(module)
+        except BaseException:
+            del sys.modules[fullname]
+            raise
+    if parent in sys.modules:
+        setattr(sys.modules[parent], child, module)
+    module_data["module"] = module
 
 
 def load_module(module_data):
-    if hasattr(sys, "getdlopenflags"):
-        # It can be useful to set rtld_flags to RTLD_GLOBAL. This allows
-        # extensions that are loaded later to share the symbols from this
-        # extension. This is primarily useful in a project where several
-        # interdependent extensions are loaded but it's undesirable to combine
-        # the multiple extensions into a single extension.
-        old_flags = sys.getdlopenflags()
-        new_flags = old_flags | cppimport.settings["rtld_flags"]
-        sys.setdlopenflags(new_flags)
-        _actually_load_module(module_data)
-        sys.setdlopenflags(old_flags)
-    else:
+    with phase("load", module_data["fullname"]), rtld_flags():
         _actually_load_module(module_data)
 
 
@@ -153,5 +369,5 @@ def try_load(module_data):
             f"ImportError during import with matching checksum: {e}. Trying to rebuild."
         )
         with suppress(OSError):
-            os.remove(module_data["fullname"])
+            os.remove(module_data["ext_path"])
         return False
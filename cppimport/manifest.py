@@ -0,0 +1,153 @@
+"""
+A build manifest maps module names to the source and compiled extension
+written by `python -m cppimport build --manifest PATH`. When
+`cppimport.settings["manifest"]` points at a manifest, `cppimport.imp` and the
+import hook look modules up there instead of searching sys.path.
+"""
+
+import json
+import logging
+import os
+import tempfile
+
+import cppimport
+
+logger = logging.getLogger(__name__)
+
+_MANIFEST_VERSION = 2
+
+# Maps a manifest path to its modules with absolute paths.
+_loaded = {}
+
+
+def write_manifest(manifest_path, modules):
+    """
+    Write a manifest for `modules`, a list of (fullname, filepath) pairs of
+    modules that have already been built. Paths are stored relative to the
+    manifest so that the tree can be relocated.
+    """
+    from cppimport.checksum import _load_checksum_trailer
+    from cppimport.importer import setup_module_data
+    from cppimport.toolchain import build_variant
+
+    manifest_path = os.path.abspath(manifest_path)
+    manifest_dir = os.path.dirname(manifest_path)
+    variant = build_variant()
+    entries = {}
+    for fullname, filepath in modules:
+        module_data = setup_module_data(fullname, os.path.abspath(filepath))
+        trailer = _load_checksum_trailer(module_data)
+        if trailer is None:
+            raise ValueError(f"{filepath} has not been built.")
+        entries[fullname] = dict(
+            filepath=os.path.relpath(module_data["filepath"], manifest_dir),
+            ext_path=os.path.relpath(module_data["ext_path"], manifest_dir),
+            checksum=trailer["checksum"],
+            build_variant=variant,
+            profile=module_data["build_profile"],
+        )
+
+    data = dict(version=_MANIFEST_VERSION, modules=entries)
+    fd, tmp_path = tempfile.mkstemp(dir=manifest_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+    _loaded.pop(manifest_path, None)
+    logger.info(f"Wrote manifest with {len(entries)} modules to {manifest_path}")
+
+
+def lookup(fullname):
+    """
+    Return the manifest entry for `fullname` from the manifest configured in
+    `cppimport.settings["manifest"]`, or None. Entries built with a different
+    build profile than the one selected in `cppimport.settings` are ignored.
+    """
+    manifest_path = cppimport.settings["manifest"]
+    if not manifest_path:
+        return None
+    modules = _loaded.get(manifest_path)
+    if modules is None:
+        modules = _loaded[manifest_path] = load_manifest(manifest_path)
+    entry = modules.get(fullname)
+    if entry is None or entry.get("profile") != cppimport.settings["build_profile"]:
+        return None
+    return entry
+
+
+def lookup_module_data(fullname):
+    """
+    Like `lookup` but return module data as produced by
+    `cppimport.importer.setup_module_data`.
+    """
+    entry = lookup(fullname)
+    if entry is None:
+        return None
+    from cppimport.importer import setup_module_data
+
+    module_data = setup_module_data(fullname, entry["filepath"])
+    module_data["ext_path"] = entry["ext_path"]
+    return module_data
+
+
+def load_manifest(manifest_path):
+    """
+    Load a manifest and return its modules with absolute paths. If
+    `cppimport.settings["manifest_verify"]` is set, every entry is checked with
+    `verify_entry` and entries that fail are dropped, so those modules are
+    found and built as if there was no manifest.
+    """
+    try:
+        with open(manifest_path, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable manifest {manifest_path}: {e}")
+        return {}
+    if data.get("version") != _MANIFEST_VERSION:
+        logger.warning(f"Ignoring manifest {manifest_path} with unknown version.")
+        return {}
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    modules = {}
+    for fullname, entry in data["modules"].items():
+        entry = dict(entry)
+        entry["filepath"] = os.path.join(manifest_dir, entry["filepath"])
+        entry["ext_path"] = os.path.join(manifest_dir, entry["ext_path"])
+        modules[fullname] = entry
+
+    if cppimport.settings["manifest_verify"]:
+        from cppimport.toolchain import build_variant
+
+        variant = build_variant()
+        for fullname, entry in list(modules.items()):
+            problem = verify_entry(entry, variant)
+            if problem is not None:
+                logger.warning(f"Ignoring manifest entry for {fullname}: {problem}")
+                del modules[fullname]
+    return modules
+
+
+def verify_entry(entry, variant):
+    """
+    Check that the extension of a manifest entry exists, carries the recorded
+    checksum and was built for the build variant `variant` with the current
+    toolchain. Returns a description of the problem or None if the entry is
+    valid.
+
+    The toolchain is compared with the components recorded in the extension's
+    trailer, so the compiler isn't run and a missing compiler counts as
+    unchanged, like for imports.
+    """
+    from cppimport.checksum import _load_checksum_trailer
+    from cppimport.toolchain import changed_components
+
+    if entry["build_variant"] != variant:
+        return "built for a different Python ABI, compiler or compiler flags"
+    trailer = _load_checksum_trailer(dict(ext_path=entry["ext_path"]))
+    if trailer is None:
+        return f"{entry['ext_path']} is missing or has no checksum"
+    if trailer["checksum"] != entry["checksum"]:
+        return f"{entry['ext_path']} has been rebuilt since the manifest was written"
+    changed = changed_components(trailer.get("toolchain") or {})
+    if changed:
+        return f"built with a different {', '.join(changed)}"
+    return None
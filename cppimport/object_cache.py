@@ -0,0 +1,159 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from cppimport.toolchain import compiler_executable, compiler_version, python_abi_tag
+
+logger = logging.getLogger(__name__)
+
+# After eviction, the cache is shrunk to this fraction of its maximum size so
+# that not every store triggers another eviction.
+_EVICTION_TARGET = 0.9
+
+
+class ObjectCache:
+    """
+    A persistent, content-addressed cache of compiled object files.
+
+    Entries are keyed on the preprocessed translation unit together with the
+    compiler, its flags and the Python ABI, so any change that can affect the
+    object file results in a different key. Each entry consists of the object
+    file and, if one was written, the `-MMD` dependency file. Entries are evicted
+    in least recently used order once the cache grows beyond `max_size` bytes.
+
+    The cache is only scanned on the first store and whenever the entries
+    stored since then may have pushed it beyond `max_size`. Entries stored by
+    other processes in the meantime are noticed on the next scan.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        # The approximate size of the cache, None until it was first scanned.
+        self._size = None
+        self._size_lock = threading.Lock()
+
+    def key(self, compiler_so, src, cc_args, extra_postargs):
+        """Compute the cache key for compiling `src`, or return None if the
+        source can't be preprocessed."""
+        # The dependency file is not part of the output of the preprocessor.
+        postargs = [a for a in extra_postargs if a != "-MMD"]
+        cmd = compiler_so + cc_args + [src, "-E"] + postargs
+        try:
+            p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError:
+            return None
+        if p.returncode != 0:
+            # Let the real compilation report the error.
+            return None
+
+        hasher = hashlib.blake2b(digest_size=20)
+        hasher.update(
+            json.dumps(
+                [
+                    python_abi_tag(),
+                    compiler_version(compiler_executable(compiler_so)),
+                    compiler_so + cc_args + extra_postargs,
+                    os.path.splitext(src)[1],
+                ]
+            ).encode("utf-8")
+        )
+        hasher.update(p.stdout)
+        return hasher.hexdigest()
+
+    def fetch(self, key, obj):
+        """Copy the cached object for `key` to `obj`. Returns True on a hit."""
+        entry = self._entry_path(key)
+        try:
+            shutil.copyfile(entry + ".o", obj)
+            if os.path.exists(entry + ".d"):
+                shutil.copyfile(entry + ".d", _depfile_path(obj))
+            # Mark the entry as recently used.
+            os.utime(entry + ".o")
+        except OSError:
+            return False
+        logger.debug(f"Object cache hit for {obj}")
+        return True
+
+    def store(self, key, obj):
+        """Add the freshly compiled `obj` to the cache under `key`."""
+        entry = self._entry_path(key)
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            # The dependency file goes first since the presence of the object
+            # file marks the entry as complete.
+            size = 0
+            if os.path.exists(_depfile_path(obj)):
+                _atomic_copy(_depfile_path(obj), entry + ".d")
+                size += os.path.getsize(entry + ".d")
+            _atomic_copy(obj, entry + ".o")
+            size += os.path.getsize(entry + ".o")
+            self._add_size(size)
+        except OSError as e:
+            logger.info(f"Failed to store {obj} in the object cache: {e}")
+
+    def _add_size(self, size):
+        with self._size_lock:
+            if self._size is not None:
+                self._size += size
+                if self._size <= self.max_size:
+                    return
+            self._size = self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits within
+        `max_size`. Returns the size of the cache afterwards."""
+        entries = []
+        total_size = 0
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith(".o"):
+                    continue
+                entry = os.path.join(dirpath, filename[:-2])
+                try:
+                    st = os.stat(entry + ".o")
+                    size = st.st_size
+                    if os.path.exists(entry + ".d"):
+                        size += os.stat(entry + ".d").st_size
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, size, entry))
+                total_size += size
+
+        if total_size <= self.max_size:
+            return total_size
+        entries.sort()
+        for _, size, entry in entries:
+            if total_size <= _EVICTION_TARGET * self.max_size:
+                break
+            for suffix in (".o", ".d"):
+                try:
+                    os.remove(entry + suffix)
+                except OSError:
+                    pass
+            total_size -= size
+        return total_size
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+
+def _depfile_path(obj):
+    return os.path.splitext(obj)[0] + ".d"
+
+
+def _atomic_copy(src, dest):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as dest_f, open(src, "rb") as src_f:
+            shutil.copyfileobj(src_f, dest_f)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
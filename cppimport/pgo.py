@@ -0,0 +1,132 @@
+"""
+Profile-guided optimization. With `cppimport.settings["pgo"] = "generate"`
+modules are built with instrumentation that records how the code runs. After
+running a representative workload, `cppimport.settings["pgo"] = "use"` rebuilds
+them optimized for the recorded profile. Both can also be selected with the
+`CPPIMPORT_PGO` environment variable or with `python -m cppimport build
+--pgo-generate` and `--pgo-use`.
+
+PGO builds are named after their mode, e.g.
+`mymodule.pgo-use.cpython-311-x86_64-linux-gnu.so`, so they don't replace the
+regular extension. The profile data of each module is stored in
+`<cache_dir>/pgo/<key>/data`. GCC finds the data of an object file by the
+object's path, so PGO builds compile in a build directory next to it that is the
+same for every build of the module. Clang's raw profiles are merged with
+`llvm-profdata` (or the tool in the `LLVM_PROFDATA` environment variable) before
+they're used.
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+
+import cppimport
+from cppimport.toolchain import build_variant, compiler_executable, compiler_version
+
+logger = logging.getLogger(__name__)
+
+MODES = ("generate", "use")
+_MERGED_PROFILE = "merged.profdata"
+
+
+def get_mode():
+    """The PGO mode from `cppimport.settings["pgo"]`: "generate", "use" or
+    None."""
+    mode = cppimport.settings["pgo"] or None
+    if mode is not None and mode not in MODES:
+        raise ValueError(
+            f"Unknown PGO mode {mode!r}, expected one of {', '.join(MODES)}."
+        )
+    return mode
+
+
+def get_pgo_dir(module_data):
+    """The directory holding the profile data and the build directory of a
+    module, shared by its builds in both modes."""
+    key = hashlib.blake2b(
+        json.dumps(
+            [
+                os.path.abspath(module_data["filepath"]),
+                module_data.get("build_profile"),
+                build_variant(),
+            ]
+        ).encode("utf-8"),
+        digest_size=10,
+    ).hexdigest()
+    return os.path.join(os.path.expanduser(cppimport.settings["cache_dir"]), "pgo", key)
+
+
+def prepare_build_dir(module_data):
+    """Return an empty build directory at the same path for every build of the
+    extension."""
+    build_path = os.path.join(get_pgo_dir(module_data), "build")
+    shutil.rmtree(build_path, ignore_errors=True)
+    os.makedirs(build_path)
+    return build_path
+
+
+def data_filepaths(module_data):
+    """The sorted paths of the profile data files recorded for a module."""
+    data_dir = os.path.join(get_pgo_dir(module_data), "data")
+    # GCC mirrors the path of each object file below the data directory.
+    return sorted(
+        os.path.join(dirpath, f)
+        for dirpath, _, filenames in os.walk(data_dir)
+        for f in filenames
+        if f.endswith((".gcda", ".profraw"))
+    )
+
+
+def pgo_flags(mode, compiler_so, pgo_dir):
+    """Return the compiler and linker flags for building with the PGO mode
+    `mode` using the GCC-compatible compiler command `compiler_so`."""
+    data_dir = os.path.join(pgo_dir, "data")
+    is_clang = "clang" in compiler_version(compiler_executable(compiler_so)).lower()
+    if mode == "generate":
+        os.makedirs(data_dir, exist_ok=True)
+        flags = ["-fprofile-generate=" + data_dir]
+        if not is_clang:
+            # Modules may be called from several threads.
+            flags.append("-fprofile-update=atomic")
+        return flags, list(flags)
+    if is_clang:
+        profile = _merge_clang_profiles(data_dir)
+        if profile is None:
+            return [], []
+        return [
+            "-fprofile-use=" + profile,
+            "-Wno-profile-instr-unprofiled",
+            "-Wno-profile-instr-out-of-date",
+        ], []
+    # Functions that changed since the profile was recorded are just compiled
+    # without it.
+    return [
+        "-fprofile-use=" + data_dir,
+        "-fprofile-correction",
+        "-Wno-missing-profile",
+        "-Wno-coverage-mismatch",
+    ], []
+
+
+def _merge_clang_profiles(data_dir):
+    raw_profiles = sorted(glob.glob(os.path.join(data_dir, "*.profraw")))
+    if not raw_profiles:
+        logger.warning(f"No profile data in {data_dir}; building without PGO.")
+        return None
+    profile = os.path.join(data_dir, _MERGED_PROFILE)
+    llvm_profdata = os.environ.get("LLVM_PROFDATA", "llvm-profdata")
+    try:
+        subprocess.run(
+            [llvm_profdata, "merge", "-output=" + profile] + raw_profiles,
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning(f"Failed to merge the profile data in {data_dir}: {e}")
+        return None
+    return profile
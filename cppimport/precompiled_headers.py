@@ -0,0 +1,130 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+from cppimport.toolchain import compiler_executable, compiler_version, python_abi_tag
+
+logger = logging.getLogger(__name__)
+
+CPP_SOURCE_EXTS = (".cpp", ".cc", ".cxx", ".c++", ".C")
+_WRAPPER_NAME = "cppimport_pch.h"
+# A line marker in preprocessed output: `# <line> "<file>" <flags>`.
+_LINE_MARKER = re.compile(rb'^# \d+ "((?:\\.|[^"\\])*)"((?: \d+)*)$', re.MULTILINE)
+
+
+def get_precompiled_header(compiler_so, headers, cc_args, extra_postargs, pch_dir):
+    """
+    Return the path to a wrapper header including all of `headers` that has
+    been precompiled with the given compiler and flags, together with the
+    fingerprint of the precompiled header and the non-system headers it was
+    built from. Passing the wrapper to the compiler with `-include` makes it use
+    the precompiled header.
+
+    Precompiled headers are stored in `pch_dir` keyed on the compiler, the
+    flags, the Python ABI and the preprocessed headers, so a precompiled header
+    is only built once for each combination. Returns (None, None, []) if the
+    precompiled header can't be built.
+    """
+    wrapper_text = "".join(f"#include {_quote_header(h)}\n" for h in headers)
+    # Include directories and dependency files don't affect the precompiled
+    # header except through the preprocessed text.
+    flags = [a for a in cc_args if a != "-c"]
+    postargs = [a for a in extra_postargs if a != "-MMD"]
+    codegen_flags = [a for a in flags + postargs if not a.startswith("-I")]
+
+    try:
+        p = subprocess.run(
+            compiler_so + flags + ["-x", "c++", "-E", "-"] + postargs,
+            input=wrapper_text.encode("utf-8"),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except OSError as e:
+        logger.warning(f"Failed to preprocess the precompiled header: {e}")
+        return None, None, []
+    if p.returncode != 0:
+        logger.warning(
+            "Failed to preprocess the precompiled header; compiling without it:"
+            f" {p.stderr.decode('utf-8', 'replace')}"
+        )
+        return None, None, []
+    # Translation units using the precompiled header don't list these headers
+    # in their dependency files.
+    dependencies = _included_headers(p.stdout)
+
+    version = compiler_version(compiler_executable(compiler_so))
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(
+        json.dumps(
+            [python_abi_tag(), version, compiler_so + codegen_flags, headers]
+        ).encode("utf-8")
+    )
+    hasher.update(p.stdout)
+    fingerprint = hasher.hexdigest()
+
+    # GCC looks for `<header>.gch` and clang for `<header>.pch`.
+    pch_ext = ".pch" if "clang" in version else ".gch"
+    entry_dir = os.path.join(pch_dir, fingerprint)
+    wrapper_path = os.path.join(entry_dir, _WRAPPER_NAME)
+    if os.path.exists(wrapper_path + pch_ext):
+        # Mark the precompiled header as recently used.
+        os.utime(wrapper_path + pch_ext)
+        return wrapper_path, fingerprint, dependencies
+
+    os.makedirs(pch_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=pch_dir, suffix=".tmp")
+    try:
+        tmp_wrapper_path = os.path.join(tmp_dir, _WRAPPER_NAME)
+        with open(tmp_wrapper_path, "w") as f:
+            f.write(wrapper_text)
+        cmd = (
+            compiler_so
+            + flags
+            + ["-x", "c++-header", tmp_wrapper_path, "-o", tmp_wrapper_path + pch_ext]
+            + postargs
+        )
+        logger.info(f"Building precompiled header: {' '.join(cmd)}")
+        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if p.returncode != 0:
+            logger.warning(
+                "Failed to build the precompiled header; compiling without it:"
+                f" {p.stdout.decode('utf-8', 'replace')}"
+            )
+            return None, None, []
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another process published the same precompiled header first.
+            if not os.path.exists(wrapper_path + pch_ext):
+                raise
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return wrapper_path, fingerprint, dependencies
+
+
+def _included_headers(preprocessed):
+    """
+    Return the headers named by the line markers of the preprocessed source,
+    skipping system headers (flag 3), pseudo files like `<stdin>` and the
+    working directory that GCC records with `-g`.
+    """
+    headers = []
+    for m in _LINE_MARKER.finditer(preprocessed):
+        if b"3" in m.group(2).split():
+            continue
+        path = re.sub(rb"\\(.)", rb"\1", m.group(1)).decode("utf-8", "replace")
+        if path not in headers and os.path.isfile(path):
+            headers.append(path)
+    return headers
+
+
+def _quote_header(header):
+    if header.startswith(("<", '"')):
+        return header
+    return f"<{header}>"
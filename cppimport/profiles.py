@@ -0,0 +1,86 @@
+"""
+Build profiles: named sets of compiler and linker flags that are added to every
+module built with the profile. The profile is chosen with
+`cppimport.settings["build_profile"]` (or the environment variable
+`CPPIMPORT_BUILD_PROFILE`) or in a module's configuration block with
+`cfg['profile']`, with the setting taking precedence.
+
+Extensions built with a profile selected by the setting are named after the
+profile, e.g. `mymodule.debug.cpython-311-x86_64-linux-gnu.so`, so builds with
+different profiles coexist and the profile can be switched at import time.
+
+New profiles can be added to `PROFILES`. The flags of GCC-compatible compilers
+are listed under "unix" and those of MSVC under "msvc". Profiles that tune the
+code for the building machine set `portable` to False and are never shared
+through an artifact store.
+"""
+
+PROFILES = dict(
+    # Optimized, but runs on any machine the Python build itself runs on.
+    release=dict(
+        unix=dict(compile=["-O3", "-DNDEBUG"], link=[]),
+        msvc=dict(compile=["/O2", "/DNDEBUG"], link=[]),
+        portable=True,
+    ),
+    # Optimized for the CPU of the building machine.
+    native=dict(
+        unix=dict(compile=["-O3", "-march=native", "-DNDEBUG"], link=[]),
+        msvc=dict(compile=["/O2", "/DNDEBUG"], link=[]),
+        portable=False,
+    ),
+    debug=dict(
+        unix=dict(compile=["-O0", "-g", "-UNDEBUG"], link=["-g"]),
+        msvc=dict(compile=["/Od", "/Zi", "/UNDEBUG"], link=["/DEBUG"]),
+        portable=True,
+    ),
+    # Address and undefined behavior sanitizers. The sanitizer runtime must be
+    # preloaded into the Python process, e.g. with
+    # LD_PRELOAD=$(gcc -print-file-name=libasan.so).
+    sanitize=dict(
+        unix=dict(
+            compile=[
+                "-O1",
+                "-g",
+                "-UNDEBUG",
+                "-fno-omit-frame-pointer",
+                "-fsanitize=address,undefined",
+            ],
+            link=["-fsanitize=address,undefined"],
+        ),
+        msvc=dict(compile=["/Od", "/Zi", "/fsanitize=address"], link=["/DEBUG"]),
+        portable=True,
+    ),
+)
+
+
+def get_profile_name(module_data):
+    """The name of the profile a templated module is built with, or None."""
+    return module_data.get("build_profile") or module_data["cfg"].get("profile")
+
+
+def get_profile(name):
+    """Return the profile called `name`. Raises ValueError for unknown
+    profiles."""
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown build profile {name!r}, expected one of "
+            f"{', '.join(sorted(PROFILES))}."
+        ) from None
+
+
+def profile_flags(name, compiler_type):
+    """Return the compiler and linker flags of the profile `name` for a
+    distutils compiler of type `compiler_type`, or empty lists for no
+    profile."""
+    if not name:
+        return [], []
+    flags = get_profile(name)["msvc" if compiler_type == "msvc" else "unix"]
+    return list(flags["compile"]), list(flags["link"])
+
+
+def is_portable(name):
+    """Whether extensions built with the profile `name` run on other machines
+    than the one that built them."""
+    return not name or get_profile(name).get("portable", True)
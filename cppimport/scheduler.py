@@ -0,0 +1,147 @@
+import concurrent.futures
+import contextvars
+import logging
+import os
+import re
+import select
+import threading
+
+import cppimport
+
+logger = logging.getLogger(__name__)
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """
+    Return the compile scheduler shared by all builds in this process. A new
+    scheduler is created if `cppimport.settings["jobs"]` has changed.
+    """
+    global _scheduler
+    max_jobs = cppimport.settings["jobs"] or os.cpu_count() or 1
+    with _scheduler_lock:
+        if _scheduler is None or _scheduler.max_jobs != max_jobs:
+            if _scheduler is not None:
+                _scheduler.shutdown()
+            _scheduler = CompileScheduler(max_jobs, Jobserver.from_environ())
+        return _scheduler
+
+
+class CompileScheduler:
+    """
+    Runs compiler and linker invocations with a bound on how many run at the
+    same time across all builds in the process.
+
+    Each job needs a slot out of `max_jobs`. If a GNU make jobserver is
+    available, each job beyond the first one running in this process also
+    needs a token from the jobserver, so that cppimport cooperates with the
+    other jobs of a `make -j` build.
+    """
+
+    def __init__(self, max_jobs, jobserver=None):
+        self.max_jobs = max_jobs
+        self._slots = threading.BoundedSemaphore(max_jobs)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_jobs, thread_name_prefix="cppimport-compile"
+        )
+        self._jobserver = jobserver
+        self._implicit_token_lock = threading.Lock()
+        self._implicit_token_in_use = False
+
+    def run(self, fnc, *args, **kwargs):
+        """Run `fnc(*args, **kwargs)` in the calling thread once a job slot is
+        available."""
+        with self._slots:
+            token = self._acquire_token()
+            try:
+                return fnc(*args, **kwargs)
+            finally:
+                self._release_token(token)
+
+    def map(self, fnc, items):
+        """Run `fnc` on each of `items` concurrently on the shared worker pool and
+        return the results. The first exception raised by `fnc` is
+        re-raised once all items have finished. Each call runs in a copy of the
+        calling thread's context, so context variables carry over."""
+        futures = [
+            self._executor.submit(contextvars.copy_context().run, self.run, fnc, item)
+            for item in items
+        ]
+        concurrent.futures.wait(futures)
+        return [f.result() for f in futures]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def _acquire_token(self):
+        if self._jobserver is None:
+            return None
+        # Every process owns one implicit jobserver token which doesn't have to
+        # be read from the jobserver.
+        with self._implicit_token_lock:
+            if not self._implicit_token_in_use:
+                self._implicit_token_in_use = True
+                return None
+        return self._jobserver.acquire()
+
+    def _release_token(self, token):
+        if self._jobserver is None:
+            return
+        if token is None:
+            with self._implicit_token_lock:
+                self._implicit_token_in_use = False
+        else:
+            self._jobserver.release(token)
+
+
+class Jobserver:
+    """
+    A client for the GNU make jobserver protocol. See
+    https://www.gnu.org/software/make/manual/html_node/Job-Slots.html
+    """
+
+    def __init__(self, read_fd, write_fd):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+
+    @classmethod
+    def from_environ(cls, environ=os.environ):
+        """Connect to the jobserver advertised in MAKEFLAGS, if any."""
+        matches = re.findall(
+            r"--jobserver-(?:auth|fds)=(\S+)", environ.get("MAKEFLAGS", "")
+        )
+        if not matches:
+            return None
+        auth = matches[-1]
+        try:
+            if auth.startswith("fifo:"):
+                fd = os.open(auth[len("fifo:") :], os.O_RDWR)
+                return cls(fd, fd)
+            read_fd, write_fd = (int(fd) for fd in auth.split(","))
+            # make doesn't pass the file descriptors to commands that aren't
+            # marked as recursive with `+`.
+            os.fstat(read_fd)
+            os.fstat(write_fd)
+            return cls(read_fd, write_fd)
+        except (OSError, ValueError) as e:
+            logger.debug(f"Ignoring unusable make jobserver {auth!r}: {e}")
+            return None
+
+    def acquire(self):
+        """Block until a token is available and return it."""
+        while True:
+            try:
+                token = os.read(self.read_fd, 1)
+            except BlockingIOError:
+                select.select([self.read_fd], [], [])
+                continue
+            except InterruptedError:
+                continue
+            if token:
+                return token
+            raise OSError("The make jobserver was closed.")
+
+    def release(self, token):
+        os.write(self.write_fd, token)
@@ -1,46 +1,204 @@
+import copy
+import hashlib
+import importlib.util
 import io
 import logging
 import os
+import tempfile
+import threading
+from contextlib import suppress
 
+import mako
+import mako.codegen
 import mako.exceptions
+import mako.lexer
 import mako.lookup
+import mako.parsetree
 import mako.runtime
 import mako.template
 
+import cppimport
+
 logger = logging.getLogger(__name__)
 
+# Compiled template modules and configurations, keyed on the digest of the
+# source file. Both are also valid across processes: compiled templates are
+# stored in `<cache_dir>/mako`.
+_template_modules = {}
+_cfgs = {}
+_cache_lock = threading.Lock()
+
 
 def run_templating(module_data):
-    module_data["cfg"] = BuildArgs(
-        sources=[],
-        include_dirs=[],
-        extra_compile_args=[],
-        libraries=[],
-        library_dirs=[],
-        extra_link_args=[],
-        dependencies=[],
-        parallel=False,
+    rendered = _render(module_data)
+
+    rendered_src_filepath = get_rendered_source_filepath(
+        module_data["filepath"],
+        module_data["build_dir"],
+        module_data.get("build_profile"),
     )
+
+    os.makedirs(module_data["build_dir"], exist_ok=True)
+    with open(rendered_src_filepath, "w", newline="") as f:
+        f.write(rendered)
+
+    module_data["rendered_src_filepath"] = rendered_src_filepath
+
+
+def evaluate_cfg(module_data):
+    """
+    Return the configuration (`cfg`) of a module without rendering the whole
+    template. Only the Python blocks at the top level of the template are run,
+    and the result is memoized on the contents of the source file. Modules
+    whose configuration blocks depend on other parts of the template are
+    rendered in full instead.
+    """
+    filepath = module_data["filepath"]
+    with open(filepath, "rb") as f:
+        source = f.read()
+    key = (_source_digest(filepath, source), cppimport.settings["pybind11_pch"])
+    with _cache_lock:
+        cfg = _cfgs.get(key)
+    if cfg is None:
+        cfg = _evaluate_cfg_blocks(module_data, source)
+        with _cache_lock:
+            _cfgs[key] = cfg
+    return copy.deepcopy(cfg)
+
+
+# Templates made of only these nodes run all of their Python blocks exactly
+# once, in order. Blocks in control lines (`% if`, `% for`) and tags such as
+# `<%def>` may run any number of times, so those templates are rendered.
+_FLAT_NODES = (
+    mako.parsetree.Text,
+    mako.parsetree.Code,
+    mako.parsetree.Expression,
+    mako.parsetree.Comment,
+)
+
+
+def _evaluate_cfg_blocks(module_data, source):
+    nodes = mako.lexer.Lexer(source, module_data["filepath"]).parse().nodes
+    if all(isinstance(n, _FLAT_NODES) for n in nodes):
+        code = "\n".join(n.text for n in nodes if isinstance(n, mako.parsetree.Code))
+        namespace = dict(module_data, cfg=_new_cfg(), setup_pybind11=setup_pybind11)
+        try:
+            exec(compile(code, module_data["filepath"], "exec"), namespace)
+            return namespace["cfg"]
+        except Exception as e:
+            logger.debug(
+                f"Failed to evaluate the configuration of "
+                f"{module_data['filepath']} on its own ({e!r}); rendering the "
+                "whole template."
+            )
+    namespace = dict(module_data)
+    _render(namespace)
+    return namespace["cfg"]
+
+
+def _render(module_data):
+    module_data["cfg"] = _new_cfg()
     module_data["setup_pybind11"] = setup_pybind11
     buf = io.StringIO()
     ctx = mako.runtime.Context(buf, **module_data)
 
-    filepath = module_data["filepath"]
     try:
-        template_dirs = [os.path.dirname(filepath)]
-        lookup = mako.lookup.TemplateLookup(directories=template_dirs)
-        tmpl = lookup.get_template(module_data["filebasename"])
+        tmpl = _get_template(module_data["filepath"], module_data["filebasename"])
         tmpl.render_context(ctx)
     except:  # noqa: E722
         logger.exception(mako.exceptions.text_error_template().render())
         raise
+    return buf.getvalue()
 
-    rendered_src_filepath = get_rendered_source_filepath(filepath)
 
-    with open(rendered_src_filepath, "w", newline="") as f:
-        f.write(buf.getvalue())
+def _new_cfg():
+    return BuildArgs(
+        sources=[],
+        include_dirs=[],
+        extra_compile_args=[],
+        libraries=[],
+        library_dirs=[],
+        extra_link_args=[],
+        dependencies=[],
+        parallel=False,
+        precompiled_headers=[],
+    )
 
-    module_data["rendered_src_filepath"] = rendered_src_filepath
+
+def _get_template(filepath, uri):
+    """
+    Compiling a large template into Python code is slow, so the compiled module
+    is cached in memory and in `<cache_dir>/mako`. The cache is keyed on the
+    contents of the file rather than on its mtime like Mako's own
+    `module_directory`, which only has a resolution of one second.
+    """
+    with open(filepath, "rb") as f:
+        source = f.read()
+    digest = _source_digest(filepath, source)
+    lookup = mako.lookup.TemplateLookup(directories=[os.path.dirname(filepath)])
+    with _cache_lock:
+        module = _template_modules.get(digest)
+    if module is None:
+        module_path = os.path.join(
+            os.path.expanduser(cppimport.settings["cache_dir"]), "mako", digest + ".py"
+        )
+        module = _load_template_module(digest, module_path)
+        if module is None:
+            tmpl = mako.template.Template(
+                text=source, filename=filepath, uri=uri, lookup=lookup
+            )
+            _save_template_module(module_path, tmpl.code)
+            module = tmpl.module
+        with _cache_lock:
+            _template_modules[digest] = module
+    return mako.template.ModuleTemplate(
+        module, template_filename=filepath, template_source=source, lookup=lookup
+    )
+
+
+def _source_digest(filepath, source):
+    hasher = hashlib.blake2b(digest_size=20)
+    # The compiled module refers to the template by its path.
+    for part in [mako.__version__, filepath]:
+        hasher.update(part.encode("utf-8") + b"\0")
+    hasher.update(source)
+    return hasher.hexdigest()
+
+
+def _load_template_module(digest, module_path):
+    if not os.path.exists(module_path):
+        return None
+    try:
+        spec = importlib.util.spec_from_file_location(
+            "_cppimport_template_" + digest, module_path
+        )
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except Exception as e:
+        logger.debug(f"Failed to load the compiled template {module_path}: {e!r}")
+        return None
+    if getattr(module, "_magic_number", None) != mako.codegen.MAGIC_NUMBER:
+        return None
+    return module
+
+
+def _save_template_module(module_path, code):
+    """Failing to write the cache only costs compiling the template again."""
+    try:
+        os.makedirs(os.path.dirname(module_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(module_path), prefix=".", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(code)
+            os.replace(tmp_path, module_path)
+        except BaseException:
+            with suppress(OSError):
+                os.remove(tmp_path)
+            raise
+    except OSError as e:
+        logger.debug(f"Failed to cache the compiled template {module_path}: {e}")
 
 
 class BuildArgs(dict):
@@ -68,9 +226,15 @@ def setup_pybind11(cfg):
     # Prefix with c++11 arg instead of suffix so that if a user specifies c++14
     # (or later!) then it won't be overridden.
     cfg["compiler_args"] = ["-std=c++11", "-fvisibility=hidden"] + cfg["compiler_args"]
+    if cppimport.settings["pybind11_pch"]:
+        cfg["precompiled_headers"] += ["pybind11/pybind11.h"]
 
 
-def get_rendered_source_filepath(filepath):
-    dirname = os.path.dirname(filepath)
+def get_rendered_source_filepath(filepath, build_dir=None, profile=None):
+    if build_dir is None:
+        build_dir = os.path.dirname(filepath)
     filename = os.path.basename(filepath)
-    return os.path.join(dirname, ".rendered." + filename)
+    if profile:
+        # Builds with different profiles may run concurrently.
+        filename = profile + "." + filename
+    return os.path.join(build_dir, ".rendered." + filename)
@@ -0,0 +1,256 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import sysconfig
+
+logger = logging.getLogger(__name__)
+
+_COMPILER_WRAPPERS = ("ccache", "sccache", "distcc")
+# Environment variables that distutils uses to pick the compiler and its flags.
+_ENV_VARS = (
+    "CC",
+    "CXX",
+    "LDSHARED",
+    "CPP",
+    "CFLAGS",
+    "CPPFLAGS",
+    "LDFLAGS",
+    "ARCHFLAGS",
+)
+# Python's own build configuration that distutils takes compiler flags from.
+_SYSCONFIG_VARS = ("CC", "CXX", "LDSHARED", "CFLAGS", "CCSHARED", "LDFLAGS", "OPT")
+
+
+def python_abi_tag():
+    """The extension suffix identifying the Python ABI, e.g.
+    `.cpython-311-x86_64-linux-gnu.so`."""
+    ext_suffix = sysconfig.get_config_var("EXT_SUFFIX")
+    if ext_suffix is None:
+        ext_suffix = sysconfig.get_config_var("SO")
+    return ext_suffix
+
+
+def compiler_executable(cmd):
+    """Return the actual compiler from a command line, skipping wrappers like
+    ccache."""
+    for arg in cmd:
+        if os.path.basename(arg) not in _COMPILER_WRAPPERS:
+            return arg
+    return cmd[0]
+
+
+@functools.lru_cache(maxsize=None)
+def compiler_version(executable):
+    """Return the version banner printed by `executable --version` or an empty
+    string if the compiler can't be run."""
+    try:
+        p = subprocess.run(
+            [executable, "--version"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+    except OSError as e:
+        logger.debug(f"Failed to determine the version of {executable}: {e}")
+        return ""
+    return p.stdout.strip()
+
+
+def default_compiler():
+    """The C/C++ compiler command distutils uses by default."""
+    return shlex.split(os.environ.get("CC") or sysconfig.get_config_var("CC") or "cc")
+
+
+def toolchain_info():
+    """
+    Describe the Python ABI and the default toolchain that extensions are built
+    with: the compiler and its version along with the environment variables
+    that change the compiler or its flags.
+    """
+    info = _toolchain_config()
+    info["compiler_version"] = compiler_version(compiler_executable(info["compiler"]))
+    return info
+
+
+def fingerprint(info=None):
+    """A short hash of `toolchain_info()`."""
+    if info is None:
+        info = toolchain_info()
+    data = json.dumps(info, sort_keys=True).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def build_variant():
+    """
+    A short hash of the Python ABI, the compiler command and the compiler
+    environment variables. Unlike `fingerprint`, this doesn't run the compiler,
+    so it's also available on machines without a compiler.
+    """
+    return fingerprint(_toolchain_config())[:16]
+
+
+def _toolchain_config():
+    return dict(
+        abi=python_abi_tag(),
+        compiler=default_compiler(),
+        env={k: os.environ[k] for k in _ENV_VARS if k in os.environ},
+    )
+
+
+def trailer_components(cfg, profile=None):
+    """
+    The parts of the toolchain that an extension built with the configuration
+    `cfg` depends on, recorded in the checksum trailer: the Python version and
+    headers, the effective compiler and linker flags, the compiler executable
+    and its version and, if used, the pybind11 version and the flags of the
+    build profile.
+    """
+    components = dict(
+        python=_python_digest(),
+        flags=_flags_digest(),
+        compiler=_compiler_signature(),
+    )
+    if _uses_pybind11(cfg):
+        components["pybind11"] = _pybind11_version()
+    if profile:
+        components["profile"] = dict(name=profile, digest=profile_digest(profile))
+    return components
+
+
+def profile_digest(profile):
+    """A digest of the flags of the build profile `profile`."""
+    from cppimport.profiles import get_profile
+
+    return _digest(get_profile(profile))
+
+
+def changed_components(recorded):
+    """
+    Return the names of the components in `recorded` (see
+    `trailer_components`) that differ from the current toolchain. Only the
+    recorded components are computed and the compiler is only run if its
+    executable changed since it was recorded.
+    """
+    changed = []
+    for name, value in recorded.items():
+        if name == "compiler":
+            same = _is_same_compiler(value)
+        elif name == "profile":
+            same = _is_same_profile(value)
+        elif name in _COMPONENTS:
+            same = _COMPONENTS[name]() == value
+        else:
+            same = False
+        if not same:
+            changed.append(name)
+    return changed
+
+
+@functools.lru_cache(maxsize=None)
+def _python_digest():
+    return _digest([python_abi_tag(), sys.version, sysconfig.get_paths()["include"]])
+
+
+def _flags_digest():
+    # Not memoized as the environment may change at runtime.
+    return _digest(
+        [
+            {k: sysconfig.get_config_var(k) for k in _SYSCONFIG_VARS},
+            {k: os.environ[k] for k in _ENV_VARS if k in os.environ},
+        ]
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _pybind11_version():
+    try:
+        import pybind11
+    except ImportError:
+        return None
+    return pybind11.__version__
+
+
+def _uses_pybind11(cfg):
+    pybind11 = sys.modules.get("pybind11")
+    return pybind11 is not None and pybind11.get_include() in cfg.get(
+        "include_dirs", []
+    )
+
+
+def _compiler_path():
+    executable = compiler_executable(default_compiler())
+    return _which(executable) or executable
+
+
+# Maps (executable, PATH) to the compiler found, as searching PATH on every
+# import costs a stat call per directory.
+_which_cache = {}
+
+
+def _which(executable):
+    key = (executable, os.environ.get("PATH"))
+    path = _which_cache.get(key)
+    if path is None:
+        path = shutil.which(executable, path=key[1])
+        if path is not None:
+            _which_cache[key] = path
+    return path
+
+
+def _compiler_signature():
+    path = _compiler_path()
+    return dict(
+        path=path,
+        stat=_try_stat_signature(path),
+        version=_digest(compiler_version(path)),
+    )
+
+
+def _is_same_compiler(recorded):
+    executable = compiler_executable(default_compiler())
+    path = _which(executable)
+    if path is None:
+        # No compiler is installed, e.g. in a deployment of prebuilt
+        # extensions, so the extension couldn't be rebuilt anyway.
+        logger.debug(f"Compiler {executable} not found; assuming it's unchanged.")
+        return True
+    if path != recorded.get("path"):
+        return False
+    signature = _try_stat_signature(path)
+    if signature is not None and signature == recorded.get("stat"):
+        return True
+    # E.g. reinstalled, but possibly still the same version.
+    return _digest(compiler_version(path)) == recorded.get("version")
+
+
+def _is_same_profile(recorded):
+    try:
+        return profile_digest(recorded["name"]) == recorded["digest"]
+    except ValueError:  # The profile no longer exists.
+        return False
+
+
+def _try_stat_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def _digest(data):
+    data = json.dumps(data, sort_keys=True).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+_COMPONENTS = dict(
+    python=_python_digest,
+    flags=_flags_digest,
+    pybind11=_pybind11_version,
+)
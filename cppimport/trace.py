@@ -0,0 +1,114 @@
+"""
+Timing of the phases of importing and building a module: searching for the
+source (`find`), validating the checksum (`checksum`), waiting for the build
+lock (`lock`), templating (`templating`), compiling and linking (`build`),
+writing the checksum trailer (`trailer`) and loading the extension (`load`).
+
+Each phase results in an event that is passed to the listeners registered with
+`add_listener`. If `cppimport.settings["trace"]` (or the environment variable
+`CPPIMPORT_TRACE`) is a path, the events are also written to that file in the
+Chrome trace event format when the process exits. A `{pid}` in the path is
+replaced with the process id so that processes don't overwrite each other's
+traces. Trace files can be viewed with chrome://tracing or
+https://ui.perfetto.dev.
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import cppimport
+
+logger = logging.getLogger(__name__)
+
+_listeners = []
+_events = []
+_events_lock = threading.Lock()
+_atexit_registered = False
+
+
+def add_listener(listener):
+    """
+    Call `listener(event)` at the end of every phase. `event` is a dict with the
+    keys `module` (the module name), `phase`, `start` (seconds since the epoch),
+    `duration` (in seconds), `pid` and `thread`.
+    """
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+@contextmanager
+def phase(name, fullname):
+    """Time the enclosed code as the phase `name` of the module `fullname`."""
+    if not _listeners and not cppimport.settings["trace"]:
+        yield
+        return
+    start = time.time()
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        _emit(
+            dict(
+                module=fullname,
+                phase=name,
+                start=start,
+                duration=time.perf_counter() - t,
+                pid=os.getpid(),
+                thread=threading.get_ident(),
+            )
+        )
+
+
+def _emit(event):
+    for listener in list(_listeners):
+        try:
+            listener(event)
+        except Exception:
+            logger.exception("cppimport trace listener failed")
+    if cppimport.settings["trace"]:
+        global _atexit_registered
+        with _events_lock:
+            _events.append(event)
+            if not _atexit_registered:
+                atexit.register(_write_trace_at_exit)
+                _atexit_registered = True
+
+
+def write_trace(path):
+    """Write the events recorded so far to `path` in the Chrome trace event
+    format."""
+    with _events_lock:
+        events = list(_events)
+    trace_events = [
+        dict(
+            name=e["phase"],
+            cat="cppimport",
+            ph="X",
+            ts=e["start"] * 1e6,
+            dur=e["duration"] * 1e6,
+            pid=e["pid"],
+            tid=e["thread"],
+            args=dict(module=e["module"]),
+        )
+        for e in events
+    ]
+    path = os.path.expanduser(path.replace("{pid}", str(os.getpid())))
+    with open(path, "w") as f:
+        json.dump(dict(traceEvents=trace_events, displayTimeUnit="ms"), f)
+
+
+def _write_trace_at_exit():
+    path = cppimport.settings["trace"]
+    if path:
+        try:
+            write_trace(path)
+        except OSError as e:
+            logger.warning(f"Failed to write the cppimport trace to {path}: {e}")
@@ -0,0 +1,170 @@
+"""
+Watch mode: keep the extensions below some root directories up to date while
+their sources are being edited, so that importing them doesn't have to wait for
+the compiler. Started with `python -m cppimport watch` or `cppimport.watch`.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from cppimport import _find_buildable_filepaths, _module_name
+from cppimport.checksum import _load_checksum_trailer, _stat_signature
+from cppimport.filepaths import make_absolute
+from cppimport.importer import build_safely, is_build_needed, setup_module_data
+
+logger = logging.getLogger(__name__)
+
+
+class Watcher(threading.Thread):
+    """
+    A background thread that polls the sources found below `roots`, together
+    with the dependencies recorded in the checksum trailers of their
+    extensions, and rebuilds a module once its files have stopped changing for
+    `debounce` seconds. Builds go through `build_safely`, so they are
+    coordinated with other processes importing the same modules.
+
+    `roots` may contain directories, which are searched like by
+    `cppimport.build_all`, and individual source files.
+    """
+
+    def __init__(self, roots, interval=0.5, debounce=0.25):
+        super().__init__(name="cppimport-watch", daemon=True)
+        self.roots = [os.path.abspath(r) for r in roots]
+        self.interval = interval
+        self.debounce = debounce
+        self._stop_event = threading.Event()
+        # Keyed by the filepath of each module: its module data, the stat
+        # signatures of its files and, for modules that changed but haven't
+        # been rebuilt yet, the time of the last change.
+        self._modules = {}
+        self._signatures = {}
+        self._changed = {}
+        # Maps the filepath of each module to the signature of its extension
+        # and the dependencies listed in the extension's trailer.
+        self._trailer_deps = {}
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Failed to check for changed modules.")
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        """Stop watching and wait for a build in progress to finish."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def poll(self):
+        """
+        Check for changed files once and rebuild the modules whose files last
+        changed at least `debounce` seconds ago. Returns the filepaths of the
+        rebuilt modules.
+        """
+        now = time.monotonic()
+        modules = self._find_modules()
+        for filepath in list(self._modules):
+            if filepath not in modules:
+                del self._modules[filepath]
+                self._signatures.pop(filepath, None)
+                self._changed.pop(filepath, None)
+                self._trailer_deps.pop(filepath, None)
+        for filepath, fullname in modules.items():
+            if filepath not in self._modules:
+                self._modules[filepath] = setup_module_data(fullname, filepath)
+            signature = self._signature(self._modules[filepath])
+            if signature != self._signatures.get(filepath):
+                self._signatures[filepath] = signature
+                self._changed[filepath] = now
+
+        rebuilt = []
+        for filepath, changed_at in list(self._changed.items()):
+            if now - changed_at < self.debounce:
+                continue
+            del self._changed[filepath]
+            if self._rebuild(filepath):
+                rebuilt.append(filepath)
+            # Rebuilding changes the extension and possibly its dependencies.
+            self._signatures[filepath] = self._signature(self._modules[filepath])
+        return rebuilt
+
+    def _find_modules(self):
+        modules = {}
+        for root in self.roots:
+            if os.path.isfile(root):
+                modules[root] = _module_name(root, os.path.dirname(root))
+            elif os.path.isdir(root):
+                for filepath in _find_buildable_filepaths(root):
+                    modules[filepath] = _module_name(filepath, root)
+        return modules
+
+    def _signature(self, module_data):
+        """The stat signatures of the source, the extension and the dependencies
+        recorded in the extension's checksum trailer or, if there is none,
+        listed in the module's configuration."""
+        ext_signature = _try_stat_signature(module_data["ext_path"])
+        cached = self._trailer_deps.get(module_data["filepath"])
+        if cached is not None and cached[0] == ext_signature:
+            deps = cached[1]
+        else:
+            # The trailer is only read again once the extension has changed.
+            trailer = None
+            if ext_signature is not None:
+                trailer = _load_checksum_trailer(module_data)
+            if trailer is not None:
+                # Trailers written by old versions only list paths.
+                deps = [
+                    d["path"] if isinstance(d, dict) else d for d in trailer["deps"]
+                ]
+            else:
+                # Without a built extension, e.g. after a failed build, the
+                # files listed in the configuration are watched.
+                deps = _configured_deps(module_data)
+            self._trailer_deps[module_data["filepath"]] = (ext_signature, deps)
+
+        signature = {module_data["ext_path"]: ext_signature}
+        for path in [module_data["filepath"]] + deps:
+            signature[path] = _try_stat_signature(path)
+        return signature
+
+    def _rebuild(self, filepath):
+        module_data = setup_module_data(self._modules[filepath]["fullname"], filepath)
+        try:
+            if not is_build_needed(module_data):
+                return False
+            logger.info(f"Rebuilding {filepath}")
+            t = time.time()
+            build_safely(filepath, module_data)
+        # setuptools reports compilation errors by raising SystemExit.
+        except (Exception, SystemExit):
+            logger.exception(f"Failed to build {filepath}")
+            return False
+        logger.info(f"Rebuilt {filepath} in {time.time() - t:.1f}s")
+        return True
+
+
+def _configured_deps(module_data):
+    from cppimport.templating import evaluate_cfg
+
+    try:
+        cfg = evaluate_cfg(module_data)
+    except Exception:
+        logger.debug(
+            f"Failed to evaluate the configuration of {module_data['filepath']}"
+        )
+        return []
+    return [
+        make_absolute(module_data["filedirname"], p)
+        for p in cfg.get("sources", []) + cfg.get("dependencies", [])
+    ]
+
+
+def _try_stat_signature(path):
+    try:
+        return _stat_signature(path)
+    except OSError:
+        return None
@@ -1,10 +1,14 @@
+import concurrent.futures
 import contextlib
 import copy
 import logging
 import os
+import re
 import shutil
 import subprocess
 import sys
+import threading
+import time
 from multiprocessing import Process
 from tempfile import TemporaryDirectory
 
@@ -12,6 +16,8 @@ import pytest
 
 import cppimport
 import cppimport.build_module
+import cppimport.checksum
+import cppimport.find
 import cppimport.templating
 from cppimport.find import find_module_cpppath
 
@@ -70,6 +76,28 @@ def tmp_dir(files=None):
         yield tmp_path
 
 
+@contextlib.contextmanager
+def builds_overlap(monkeypatch, count=2):
+    """Check that the `count` builds started within the block run at the same
+    time, with a compile job for each."""
+    from cppimport.build_module import BuildImportCppExt
+
+    intervals = []
+    build_extension = BuildImportCppExt.build_extension
+
+    def timed_build_extension(self, ext):
+        start = time.monotonic()
+        build_extension(self, ext)
+        intervals.append((start, time.monotonic()))
+
+    with monkeypatch.context() as m:
+        m.setattr(BuildImportCppExt, "build_extension", timed_build_extension)
+        m.setitem(cppimport.settings, "jobs", count)
+        yield
+    assert len(intervals) == count
+    assert max(start for start, _ in intervals) < min(end for _, end in intervals)
+
+
 def test_find_module_cpppath():
     mymodule_loc = find_module_cpppath("mymodule")
     mymodule_dir = os.path.dirname(mymodule_loc)
@@ -84,11 +112,93 @@ def test_find_module_cpppath():
     assert inner == inner_correct
 
 
+def test_find_module_cpppath_sees_new_files():
+    with tmp_dir() as tmp_path:
+        sys.path.insert(0, tmp_path)
+        try:
+            assert cppimport.find._find_module_cpppath("newmodule") is None
+            with open(os.path.join(tmp_path, "newmodule.cpp"), "w") as f:
+                f.write("// cppimport\n")
+            # Force a different directory mtime even on coarse mtime filesystems.
+            os.utime(tmp_path, ns=(0, 0))
+            assert cppimport.find._find_module_cpppath("newmodule") == os.path.join(
+                tmp_path, "newmodule.cpp"
+            )
+        finally:
+            sys.path.remove(tmp_path)
+
+
 def test_get_rendered_source_filepath():
     rendered_path = cppimport.templating.get_rendered_source_filepath("abc.cpp")
     assert rendered_path == ".rendered.abc.cpp"
 
 
+def test_compiled_templates_are_cached(monkeypatch):
+    from cppimport.importer import setup_module_data
+    from cppimport.templating import run_templating
+
+    with tmp_dir() as tmp_path:
+        monkeypatch.setitem(cppimport.settings, "cache_dir", tmp_path)
+        filepath = os.path.join(tmp_path, "tmpl.cpp")
+        with open(filepath, "w") as f:
+            f.write("<% x = 1 %>${x}")
+        module_data = setup_module_data("tmpl", filepath)
+        run_templating(module_data)
+        assert len(os.listdir(os.path.join(tmp_path, "mako"))) == 1
+
+        def render():
+            run_templating(module_data)
+            with open(module_data["rendered_src_filepath"]) as f:
+                return f.read()
+
+        # Loaded from the cache in memory and from disk.
+        assert render() == "1"
+        cppimport.templating._template_modules.clear()
+        assert render() == "1"
+
+        # The cache is keyed on the contents, so a change within the same
+        # second is picked up.
+        mtime = os.stat(filepath).st_mtime_ns
+        with open(filepath, "w") as f:
+            f.write("<% x = 2 %>${x}")
+        os.utime(filepath, ns=(mtime, mtime))
+        assert render() == "2"
+        assert len(os.listdir(os.path.join(tmp_path, "mako"))) == 2
+
+
+def test_evaluate_cfg(monkeypatch):
+    from cppimport.importer import setup_module_data
+    from cppimport.templating import evaluate_cfg
+
+    module_data = setup_module_data(
+        "extra_sources", os.path.join(os.path.dirname(__file__), "extra_sources.cpp")
+    )
+    cfg = evaluate_cfg(module_data)
+    assert cfg["sources"] == ["extra_sources1.cpp"]
+    assert cfg["parallel"]
+
+    # The configuration is memoized and mutating the result doesn't affect it.
+    cfg["sources"].append("other.cpp")
+    monkeypatch.setattr(cppimport.templating, "_evaluate_cfg_blocks", None)
+    assert evaluate_cfg(module_data)["sources"] == ["extra_sources1.cpp"]
+
+    with tmp_dir() as tmp_path:
+        # Configuration blocks that depend on the rest of the template.
+        filepath = os.path.join(tmp_path, "tmpl.cpp")
+        with open(filepath, "w") as f:
+            f.write("<%def name='n()'>x.cpp</%def><% cfg['sources'] = [capture(n)] %>")
+        monkeypatch.undo()
+        monkeypatch.setitem(cppimport.settings, "cache_dir", tmp_path)
+        cfg = evaluate_cfg(setup_module_data("tmpl", filepath))
+        assert cfg["sources"] == ["x.cpp"]
+
+        # Configuration blocks that don't run.
+        with open(filepath, "w") as f:
+            f.write("% if False:\n<% cfg['sources'] = ['never.cpp'] %>\n% endif\n")
+        cfg = evaluate_cfg(setup_module_data("tmpl", filepath))
+        assert cfg["sources"] == []
+
+
 def module_tester(mod, cheer=False):
     assert mod.add(1, 2) == 3
     if cheer:
@@ -122,6 +232,45 @@ def test_inner_package_mymodule():
     module_tester(mymodule)
 
 
+def test_imp_async():
+    future = cppimport.imp_async("mymodule")
+    module_tester(future.result())
+
+
+def test_prebuild(monkeypatch):
+    import cppimport.importer
+
+    builds = []
+    orig_template_and_build = cppimport.importer.template_and_build
+
+    def template_and_build(filepath, module_data):
+        builds.append(filepath)
+        orig_template_and_build(filepath, module_data)
+
+    monkeypatch.setattr(cppimport.importer, "template_and_build", template_and_build)
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        monkeypatch.syspath_prepend(tmp_path)
+        filepath = os.path.join(tmp_path, "hook_test.cpp")
+        (future,) = cppimport.prebuild(["hook_test"])
+        assert future.result().startswith(tmp_path)
+        assert builds == [filepath]
+
+        # Threads building the same module at the same time only compile once.
+        os.remove(future.result())
+        module_data = cppimport.importer.setup_module_data("hook_test", filepath)
+        threads = [
+            threading.Thread(
+                target=cppimport.importer.build_safely, args=(filepath, module_data)
+            )
+            for _ in range(2)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert builds == [filepath, filepath]
+
+
 def test_with_file_in_syspath():
     orig_sys_path = copy.copy(sys.path)
     sys.path.append(os.path.join(os.path.dirname(__file__), "mymodule.cpp"))
@@ -154,7 +303,13 @@ struct Thing {
 
 
 def test_no_rebuild_if_no_deps_change():
-    cppimport.imp("mymodule")
+    cppimport.settings["discover_dependencies"] = False
+    cppimport.settings["force_rebuild"] = True
+    try:
+        cppimport.imp("mymodule")
+    finally:
+        cppimport.settings["discover_dependencies"] = True
+        cppimport.settings["force_rebuild"] = False
     test_code = """
 import cppimport;
 cppimport.settings["use_filelock"] = False;
@@ -165,6 +320,34 @@ assert(not hasattr(mymodule, 'Thing'))
         subprocess_check(test_code)
 
 
+def test_rebuild_after_discovered_header_change():
+    cppimport.settings["force_rebuild"] = True
+    try:
+        cppimport.imp("mymodule")
+    finally:
+        cppimport.settings["force_rebuild"] = False
+    test_code = """
+import cppimport;
+cppimport.settings["use_filelock"] = False;
+mymodule = cppimport.imp("mymodule");
+mymodule.Thing().cheer()
+"""
+    with appended("tests/thing2.h", add_to_thing):
+        subprocess_check(test_code)
+
+
+def test_read_depfile():
+    with tmp_dir() as tmp_path:
+        depfile_path = os.path.join(tmp_path, "a.d")
+        with open(depfile_path, "w") as f:
+            f.write("/build/a.o: /src/a.cpp /src/my\\ header.h \\\n /src/b.h\n")
+        assert cppimport.build_module._read_depfile(depfile_path) == [
+            "/src/a.cpp",
+            "/src/my header.h",
+            "/src/b.h",
+        ]
+
+
 def test_rebuild_header_after_change():
     cppimport.imp("mymodule")
     test_code = """
@@ -178,6 +361,277 @@ mymodule.Thing().cheer()
     assert open("tests/thing.h", "r").read() == ""
 
 
+def test_checksum_skips_reading_unchanged_files(monkeypatch):
+    from cppimport.checksum import is_checksum_valid
+    from cppimport.importer import setup_module_data, template_and_build
+
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        filepath = os.path.join(tmp_path, "hook_test.cpp")
+        os.utime(filepath, ns=(0, 0))
+        module_data = setup_module_data("hook_test", filepath)
+        template_and_build(filepath, module_data)
+
+        digested = []
+        orig_calc_file_digest = cppimport.checksum._calc_file_digest
+
+        def calc_file_digest(filepath, hash_name):
+            digested.append(filepath)
+            return orig_calc_file_digest(filepath, hash_name)
+
+        monkeypatch.setattr(cppimport.checksum, "_calc_file_digest", calc_file_digest)
+        assert is_checksum_valid(module_data)
+        assert digested == []
+
+        with appended(filepath, "// touched"):
+            assert not is_checksum_valid(module_data)
+        assert digested == [filepath]
+
+
+def test_release_mode_does_not_import_build_toolchain():
+    cppimport.build("hook_test")
+    test_code = """
+import sys;
+import cppimport;
+cppimport.settings["release_mode"] = True;
+hook_test = cppimport.imp("hook_test");
+assert hook_test.sub(3, 1) == 2;
+build_modules = ["setuptools", "mako", "filelock", "cppimport.build_module"];
+assert not [m for m in build_modules if m in sys.modules]
+"""
+    subprocess_check(test_code)
+
+
+def _total_import_time_ms(test_code):
+    """The total time spent importing modules while running `test_code`, as
+    reported by `python -X importtime`."""
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", test_code],
+        cwd=os.path.dirname(__file__),
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    self_times = re.findall(rb"^import time:\s+(\d+) \|", p.stderr, re.MULTILINE)
+    return sum(int(t) for t in self_times) / 1000
+
+
+def test_release_mode_import_time():
+    cppimport.build("hook_test")
+    test_code = """
+import cppimport;
+cppimport.settings["release_mode"] = True;
+cppimport.imp("hook_test")
+"""
+    release_ms = _total_import_time_ms(test_code)
+    # What the same import cost when the build toolchain was always imported.
+    toolchain_ms = _total_import_time_ms(
+        "import setuptools, mako.template, filelock;" + test_code
+    )
+    print(f"Import time: {release_ms:.0f} ms, with the toolchain {toolchain_ms:.0f} ms")
+    assert release_ms < toolchain_ms / 2
+
+
+def test_out_of_tree_build_dir(monkeypatch):
+    from cppimport.importer import setup_module_data, template_and_build
+
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        src_dir = os.path.join(tmp_path, "src")
+        build_dir = os.path.join(tmp_path, "build")
+        os.mkdir(src_dir)
+        shutil.move(os.path.join(tmp_path, "hook_test.cpp"), src_dir)
+        filepath = os.path.join(src_dir, "hook_test.cpp")
+        monkeypatch.setitem(cppimport.settings, "build_dir", build_dir)
+
+        module_data = setup_module_data("hook_test", filepath)
+        assert module_data["ext_path"].startswith(build_dir)
+        template_and_build(filepath, module_data)
+        assert os.path.exists(module_data["ext_path"])
+        assert os.listdir(src_dir) == ["hook_test.cpp"]
+
+        # A different compiler gets its own directory.
+        monkeypatch.setenv("CC", "clang")
+        other_module_data = setup_module_data("hook_test", filepath)
+        assert other_module_data["ext_path"] != module_data["ext_path"]
+
+
+def test_build_dir_is_shared_by_build_all_and_imports(monkeypatch):
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        pkg_dir = os.path.join(tmp_path, "pkg")
+        build_dir = os.path.join(tmp_path, "build")
+        os.mkdir(pkg_dir)
+        shutil.move(os.path.join(tmp_path, "hook_test.cpp"), pkg_dir)
+        open(os.path.join(pkg_dir, "__init__.py"), "w").close()
+        monkeypatch.setitem(cppimport.settings, "build_dir", build_dir)
+        cppimport.build_all(tmp_path)
+
+        # build_all names the module after the file, the import after the
+        # package, but both must use the same extension.
+        test_code = f"""
+import sys;
+sys.path.insert(0, {tmp_path!r});
+import cppimport, cppimport.import_hook;
+cppimport.settings["use_filelock"] = False;
+cppimport.settings["build_dir"] = {build_dir!r};
+sys.modules["cppimport.build_module"] = None;
+import pkg.hook_test;
+assert pkg.hook_test.sub(3, 1) == 2;
+assert pkg.hook_test.__file__.startswith({build_dir!r})
+"""
+        subprocess_check(test_code)
+
+
+def test_extensions_are_published_atomically():
+    from cppimport.checksum import _load_checksum_trailer
+    from cppimport.importer import setup_module_data, template_and_build
+
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        filepath = os.path.join(tmp_path, "hook_test.cpp")
+        module_data = setup_module_data("hook_test", filepath)
+        template_and_build(filepath, module_data)
+        ext_path = module_data["ext_path"]
+        with open(ext_path, "rb") as f:
+            contents = f.read()
+        trailer = _load_checksum_trailer(module_data)
+
+        # A failed build leaves the existing extension untouched.
+        with appended(filepath, ";asdf;"):
+            with pytest.raises(SystemExit):
+                template_and_build(filepath, module_data)
+        with open(ext_path, "rb") as f:
+            assert f.read() == contents
+
+        # A rebuild replaces the file rather than writing to it, so a reader
+        # holding the old file keeps seeing the complete old extension.
+        with open(ext_path, "rb") as f:
+            template_and_build(filepath, module_data)
+            assert f.read() == contents
+        assert _load_checksum_trailer(module_data)["time_ns"] > trailer["time_ns"]
+        assert not [f for f in os.listdir(tmp_path) if f.startswith(".hook_test")]
+
+
+def _check_artifact_store(monkeypatch, store, corrupt):
+    from cppimport.checksum import is_checksum_valid
+    from cppimport.importer import setup_module_data, template_and_build
+
+    monkeypatch.setitem(cppimport.settings, "artifact_store", store)
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        filepath = os.path.join(tmp_path, "hook_test.cpp")
+        module_data = setup_module_data("hook_test", filepath)
+        template_and_build(filepath, module_data)
+
+        # Another machine fetches the artifact instead of compiling.
+        os.remove(module_data["ext_path"])
+        builds = []
+        orig_build_module = cppimport.build_module.build_module
+        monkeypatch.setattr(
+            cppimport.build_module,
+            "build_module",
+            lambda md: builds.append(md) or orig_build_module(md),
+        )
+        module_data = setup_module_data("hook_test", filepath)
+        template_and_build(filepath, module_data)
+        assert builds == []
+        assert is_checksum_valid(module_data)
+
+        # A corrupted artifact is ignored.
+        corrupt()
+        os.remove(module_data["ext_path"])
+        module_data = setup_module_data("hook_test", filepath)
+        template_and_build(filepath, module_data)
+        assert len(builds) == 1
+        assert is_checksum_valid(module_data)
+
+        # The key changes with the source.
+        with open(filepath, "a") as f:
+            f.write("\n// changed\n")
+        module_data = setup_module_data("hook_test", filepath)
+        template_and_build(filepath, module_data)
+        assert len(builds) == 2
+
+
+def test_artifact_key_covers_toolchain(monkeypatch):
+    import cppimport.toolchain
+    from cppimport.artifact_store import artifact_key
+    from cppimport.importer import setup_module_data
+    from cppimport.templating import run_templating
+
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        module_data = setup_module_data(
+            "hook_test", os.path.join(tmp_path, "hook_test.cpp")
+        )
+        run_templating(module_data)
+        key = artifact_key(module_data)
+        # Machines with another pybind11 version or Python build flags don't
+        # share artifacts.
+        for name in ["_pybind11_version", "_flags_digest"]:
+            with monkeypatch.context() as m:
+                m.setattr(cppimport.toolchain, name, lambda: "other")
+                assert artifact_key(module_data) != key
+        assert artifact_key(module_data) == key
+
+
+def test_incomplete_artifact_store():
+    from cppimport.artifact_store import ArtifactStore
+
+    class FetchOnlyStore(ArtifactStore):
+        def fetch(self, key, dest):
+            return None
+
+    with pytest.raises(TypeError):
+        FetchOnlyStore()
+
+
+def test_local_artifact_store(monkeypatch):
+    with tmp_dir() as store_dir:
+
+        def corrupt():
+            for directory, _, files in os.walk(store_dir):
+                for file in files:
+                    if file.endswith(".bin"):
+                        with open(os.path.join(directory, file), "ab") as f:
+                            f.write(b"garbage")
+
+        _check_artifact_store(monkeypatch, store_dir, corrupt)
+
+
+def test_http_artifact_store(monkeypatch):
+    import http.server
+
+    blobs = {}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in blobs:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(blobs[self.path])))
+            self.end_headers()
+            self.wfile.write(blobs[self.path])
+
+        def do_PUT(self):
+            blobs[self.path] = self.rfile.read(int(self.headers["Content-Length"]))
+            self.send_response(201)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+
+        def corrupt():
+            for path in blobs:
+                if path.endswith(".bin"):
+                    blobs[path] = blobs[path][:-1]
+
+        url = f"http://127.0.0.1:{server.server_address[1]}/cache"
+        _check_artifact_store(monkeypatch, url, corrupt)
+        assert len(blobs) == 4
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 def test_raw_extensions():
     raw_extension = cppimport.imp("raw_extension")
     assert raw_extension.add(1, 2) == 3
@@ -190,6 +644,278 @@ def test_extra_sources_and_parallel():
     assert mod.square_sum(3, 4) == 25
 
 
+def test_object_cache(monkeypatch):
+    from cppimport.object_cache import ObjectCache
+
+    hits = []
+    orig_fetch = ObjectCache.fetch
+
+    def fetch(self, key, obj):
+        hit = orig_fetch(self, key, obj)
+        hits.append(hit)
+        return hit
+
+    monkeypatch.setattr(ObjectCache, "fetch", fetch)
+    with tmp_dir() as cache_dir:
+        monkeypatch.setitem(cppimport.settings, "cache_dir", cache_dir)
+        monkeypatch.setitem(cppimport.settings, "object_cache", True)
+        monkeypatch.setitem(cppimport.settings, "force_rebuild", True)
+        cppimport.build("extra_sources")
+        assert hits == [False, False]
+        cppimport.build("extra_sources")
+        assert hits == [False, False, True, True]
+
+    test_code = """
+import cppimport;
+cppimport.settings["use_filelock"] = False;
+mod = cppimport.imp("extra_sources");
+assert(mod.square_sum(3, 4) == 25)
+"""
+    subprocess_check(test_code)
+
+
+def test_object_cache_eviction():
+    from cppimport.object_cache import ObjectCache
+
+    with tmp_dir() as tmp_path:
+        cache = ObjectCache(os.path.join(tmp_path, "cache"), max_size=25)
+        obj = os.path.join(tmp_path, "a.o")
+        for i, key in enumerate(["aa00", "bb00", "cc00"]):
+            with open(obj, "wb") as f:
+                f.write(b"x" * 10)
+            cache.store(key, obj)
+            os.utime(cache._entry_path(key) + ".o", ns=(i, i))
+        cache.evict()
+        assert not os.path.exists(cache._entry_path("aa00") + ".o")
+        assert os.path.exists(cache._entry_path("cc00") + ".o")
+
+
+def test_object_cache_scans_only_when_full(monkeypatch):
+    from cppimport.object_cache import ObjectCache
+
+    with tmp_dir() as tmp_path:
+        cache = ObjectCache(os.path.join(tmp_path, "cache"), max_size=45)
+        scans = []
+        orig_evict = cache.evict
+        monkeypatch.setattr(cache, "evict", lambda: scans.append(1) or orig_evict())
+        obj = os.path.join(tmp_path, "a.o")
+        with open(obj, "wb") as f:
+            f.write(b"x" * 10)
+        for key in ["aa00", "bb00", "cc00", "dd00"]:
+            cache.store(key, obj)
+        assert len(scans) == 1
+        cache.store("ee00", obj)
+        assert len(scans) == 2
+        keys = ["aa00", "bb00", "cc00", "dd00", "ee00"]
+        stored = [k for k in keys if os.path.exists(cache._entry_path(k) + ".o")]
+        assert len(stored) == 4
+
+
+def test_precompiled_headers(monkeypatch):
+    from cppimport.checksum import _load_checksum_trailer
+    from cppimport.importer import setup_module_data, template_and_build
+
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        monkeypatch.setitem(cppimport.settings, "cache_dir", tmp_path)
+        monkeypatch.setitem(cppimport.settings, "pybind11_pch", True)
+        filepath = os.path.join(tmp_path, "hook_test.cpp")
+        module_data = setup_module_data("hook_test", filepath)
+        template_and_build(filepath, module_data)
+        fingerprint = module_data["pch_fingerprint"]
+        assert fingerprint is not None
+        pch_files = os.listdir(os.path.join(tmp_path, "pch", fingerprint))
+        assert any(f.endswith((".gch", ".pch")) for f in pch_files)
+        assert _load_checksum_trailer(module_data)["pch"] == fingerprint
+
+        module_data = setup_module_data("hook_test", filepath)
+        template_and_build(filepath, module_data)
+        assert module_data["pch_fingerprint"] == fingerprint
+
+
+def test_precompiled_header_changes_rebuild(monkeypatch):
+    from cppimport.checksum import _load_checksum_trailer
+    from cppimport.importer import setup_module_data, template_and_build
+
+    src = """<%
+setup_pybind11(cfg)
+cfg['precompiled_headers'] = ['pch_value.h']
+%>
+#include <pybind11/pybind11.h>
+PYBIND11_MODULE(pch_test, m) { m.def("value", value); }
+"""
+    with tmp_dir() as tmp_path:
+        monkeypatch.setitem(cppimport.settings, "cache_dir", tmp_path)
+        filepath = os.path.join(tmp_path, "pch_test.cpp")
+        header_path = os.path.join(tmp_path, "pch_value.h")
+        with open(filepath, "w") as f:
+            f.write(src)
+        with open(header_path, "w") as f:
+            f.write("inline int value() { return 1; }\n")
+        module_data = setup_module_data("pch_test", filepath)
+        template_and_build(filepath, module_data)
+        assert module_data["pch_fingerprint"] is not None
+        trailer = _load_checksum_trailer(module_data)
+        assert header_path in [d["path"] for d in trailer["deps"]]
+        assert cppimport.checksum.is_checksum_valid(module_data)
+
+        with open(header_path, "w") as f:
+            f.write("inline int value() { return 2; }\n")
+        assert not cppimport.checksum.is_checksum_valid(module_data)
+
+
+def test_compile_scheduler_honours_jobserver():
+    from cppimport.scheduler import CompileScheduler, Jobserver
+
+    read_fd, write_fd = os.pipe()
+    # make hands out one token in addition to the implicit token of each job.
+    os.write(write_fd, b"+")
+    jobserver = Jobserver.from_environ(
+        {"MAKEFLAGS": f" -j2 --jobserver-auth={read_fd},{write_fd}"}
+    )
+    scheduler = CompileScheduler(4, jobserver)
+
+    lock = threading.Lock()
+    active = [0, 0]
+
+    def job(i):
+        with lock:
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+        return i
+
+    try:
+        assert scheduler.map(job, range(8)) == list(range(8))
+        assert active[1] == 2
+        assert os.read(read_fd, 1) == b"+"
+    finally:
+        scheduler.shutdown()
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def test_build_all_parallel():
+    from cppimport.importer import get_extension_suffix
+
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        os.mkdir(os.path.join(tmp_path, "sub"))
+        shutil.copyfile(
+            "tests/hook_test.cpp", os.path.join(tmp_path, "sub", "hook_test.cpp")
+        )
+        with open(os.path.join(tmp_path, "broken.cpp"), "w") as f:
+            f.write("// cppimport\nasdf;\n")
+        with pytest.raises(SystemExit):
+            cppimport.build_all(tmp_path, jobs=2)
+        for d in [tmp_path, os.path.join(tmp_path, "sub")]:
+            assert os.path.exists(os.path.join(d, "hook_test" + get_extension_suffix()))
+
+
+def test_builds_in_threads_overlap(monkeypatch):
+    from cppimport.importer import setup_module_data, template_and_build
+
+    stdout = sys.stdout
+    with tmp_dir() as tmp_path:
+        filepaths = []
+        for d in ["a", "b"]:
+            os.mkdir(os.path.join(tmp_path, d))
+            filepaths.append(os.path.join(tmp_path, d, "hook_test.cpp"))
+            shutil.copyfile("tests/hook_test.cpp", filepaths[-1])
+
+        def build(filepath):
+            template_and_build(filepath, setup_module_data("hook_test", filepath))
+
+        with builds_overlap(monkeypatch):
+            with concurrent.futures.ThreadPoolExecutor(2) as executor:
+                list(executor.map(build, filepaths))
+    assert sys.stdout is stdout
+
+
+def test_parallel_build_output_is_captured(monkeypatch, capsys):
+    from cppimport.importer import setup_module_data, template_and_build
+
+    monkeypatch.setitem(cppimport.settings, "jobs", 2)
+    with tmp_dir(["tests/extra_sources.cpp", "tests/extra_sources1.cpp"]) as tmp_path:
+        filepath = os.path.join(tmp_path, "extra_sources.cpp")
+        module_data = setup_module_data("extra_sources", filepath)
+        template_and_build(filepath, module_data)
+        assert module_data["cfg"]["parallel"]
+    # The compile jobs run on the scheduler's threads write the compiler
+    # commands to the build's buffer.
+    assert capsys.readouterr().out == ""
+
+
+def test_build_manifest(monkeypatch):
+    import json
+
+    import cppimport.manifest
+    import cppimport.toolchain
+    from cppimport.__main__ import _run_from_commandline
+
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        manifest_path = os.path.join(tmp_path, "manifest.json")
+        _run_from_commandline(["cppimport", "build", tmp_path, "-m", manifest_path])
+        with open(manifest_path, "r") as f:
+            entry = json.load(f)["modules"]["hook_test"]
+        assert entry["filepath"] == "hook_test.cpp"
+
+        test_code = f"""
+import cppimport;
+cppimport.settings["manifest"] = {manifest_path!r};
+cppimport.settings["release_mode"] = True;
+hook_test = cppimport.imp("hook_test");
+assert hook_test.__file__.startswith({tmp_path!r})
+"""
+        subprocess_check(test_code)
+
+        monkeypatch.setitem(cppimport.settings, "manifest", manifest_path)
+        monkeypatch.setitem(cppimport.settings, "manifest_verify", True)
+        monkeypatch.setattr(cppimport.manifest, "_loaded", {})
+        assert cppimport.manifest.lookup("hook_test") is not None
+
+        # Hosts without a compiler can verify the manifest.
+        with monkeypatch.context() as m:
+            m.setenv("PATH", os.path.join(tmp_path, "nonexistent"))
+            m.setattr(cppimport.toolchain, "compiler_version", lambda path: "")
+            m.setattr(cppimport.manifest, "_loaded", {})
+            assert cppimport.manifest.lookup("hook_test") is not None
+
+        entry["checksum"] = "stale"
+        with open(manifest_path, "w") as f:
+            data = dict(version=cppimport.manifest._MANIFEST_VERSION)
+            json.dump(dict(data, modules=dict(hook_test=entry)), f)
+        monkeypatch.setattr(cppimport.manifest, "_loaded", {})
+        assert cppimport.manifest.lookup("hook_test") is None
+
+
+def test_build_manifest_with_build_dir(monkeypatch):
+    from cppimport.__main__ import _run_from_commandline
+
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        pkg_dir = os.path.join(tmp_path, "pkg")
+        build_dir = os.path.join(tmp_path, "build")
+        os.mkdir(pkg_dir)
+        shutil.move(os.path.join(tmp_path, "hook_test.cpp"), pkg_dir)
+        open(os.path.join(pkg_dir, "__init__.py"), "w").close()
+        manifest_path = os.path.join(tmp_path, "manifest.json")
+        monkeypatch.setitem(cppimport.settings, "build_dir", build_dir)
+        _run_from_commandline(["cppimport", "build", tmp_path, "-m", manifest_path])
+
+        test_code = f"""
+import sys;
+sys.path.insert(0, {tmp_path!r});
+import cppimport, cppimport.import_hook;
+cppimport.settings["manifest"] = {manifest_path!r};
+cppimport.settings["build_dir"] = {build_dir!r};
+cppimport.settings["release_mode"] = True;
+import pkg.hook_test;
+assert pkg.hook_test.sub(3, 1) == 2;
+assert pkg.hook_test.__file__.startswith({build_dir!r})
+"""
+        subprocess_check(test_code)
+
+
 def test_import_hook():
     import cppimport.import_hook
 
@@ -202,6 +928,77 @@ def test_import_hook():
     assert hook_test.sub(3, 1) == 2
 
 
+def test_lazy_import_hook():
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        test_code = f"""
+import os, sys;
+sys.path.insert(0, {tmp_path!r});
+import cppimport, cppimport.import_hook;
+cppimport.settings["use_filelock"] = False;
+cppimport.settings["lazy"] = True;
+import hook_test;
+import hook_test as imported_again;
+import importlib;
+assert importlib.reload(hook_test) is hook_test is imported_again;
+assert sys.modules["hook_test"].__spec__.name == hook_test.__name__ == "hook_test";
+assert os.listdir({tmp_path!r}) == ["hook_test.cpp"];
+assert "cppimport.build_module" not in sys.modules;
+assert hook_test.sub(3, 1) == 2;
+assert "cppimport.build_module" in sys.modules;
+assert type(hook_test) is type(sys);
+assert sys.modules["hook_test"].sub is hook_test.sub
+"""
+        subprocess_check(test_code)
+
+
+def test_import_hook_spec():
+    import cppimport.import_hook
+
+    spec = cppimport.import_hook.hook_obj.find_spec("hook_test", None)
+    assert isinstance(spec.loader, cppimport.import_hook.CppImportLoader)
+    assert spec.origin == spec.loader.module_data["ext_path"]
+    assert os.path.basename(spec.loader.module_data["filepath"]) == "hook_test.cpp"
+
+
+def test_import_hook_negative_cache():
+    import importlib
+
+    import cppimport.import_hook
+
+    hook = cppimport.import_hook.hook_obj
+    assert hook.find_spec("not_a_cpp_module", None) is None
+    assert "not_a_cpp_module" in hook._not_found
+    assert hook.find_spec("sys", None) is None
+    assert "sys" in hook._not_found
+
+    importlib.invalidate_caches()
+    assert "not_a_cpp_module" not in hook._not_found
+
+
+def test_import_hook_negative_cache_sees_new_files():
+    import cppimport.import_hook
+
+    hook = cppimport.import_hook.hook_obj
+    with tmp_dir() as tmp_path:
+        sys.path.insert(0, tmp_path)
+        try:
+            filepath = os.path.join(tmp_path, "created_at_runtime.cpp")
+            assert hook.find_spec("created_at_runtime", None) is None
+            with open(filepath, "w") as f:
+                f.write("// not opted in\n")
+            # Force different mtimes even on coarse mtime filesystems.
+            os.utime(tmp_path, ns=(0, 0))
+            assert hook.find_spec("created_at_runtime", None) is None
+
+            with open(filepath, "w") as f:
+                f.write("// cppimport\n")
+            os.utime(filepath, ns=(0, 0))
+            spec = hook.find_spec("created_at_runtime", None)
+            assert spec.loader.module_data["filepath"] == filepath
+        finally:
+            sys.path.remove(tmp_path)
+
+
 def test_submodule_import_hook():
     import cppimport.import_hook
 
@@ -249,3 +1046,423 @@ import hook_test;
             p.join()
 
         assert all(p.exitcode == 0 for p in processes)
+
+
+def test_watch():
+    from cppimport.importer import setup_module_data
+    from cppimport.watcher import Watcher
+
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        filepath = os.path.join(tmp_path, "hook_test.cpp")
+        watcher = Watcher([tmp_path], debounce=0.2)
+        # Changes are only acted upon after the debounce time.
+        assert watcher.poll() == []
+        time.sleep(0.2)
+        assert watcher.poll() == [filepath]
+        assert watcher.poll() == []
+
+        with open(filepath, "a") as f:
+            f.write("\n// changed\n")
+        assert watcher.poll() == []
+        with open(filepath, "a") as f:
+            f.write("\n// changed again\n")
+        assert watcher.poll() == []
+        time.sleep(0.2)
+        assert watcher.poll() == [filepath]
+        time.sleep(0.2)
+        assert watcher.poll() == []
+
+        # The API runs the watcher in a background thread.
+        os.remove(setup_module_data("hook_test", filepath)["ext_path"])
+        watcher = cppimport.watch([tmp_path], interval=0.05, debounce=0.05)
+        try:
+            for _ in range(600):
+                if cppimport.checksum.is_checksum_valid(
+                    setup_module_data("hook_test", filepath)
+                ):
+                    break
+                time.sleep(0.1)
+            else:
+                assert False, "The watcher didn't rebuild the module."
+        finally:
+            watcher.stop()
+
+
+def test_build_daemon(monkeypatch):
+    import cppimport.importer
+    from cppimport.daemon import request_build
+    from cppimport.importer import build_safely, setup_module_data
+
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        socket_path = os.path.join(tmp_path, "daemon.sock")
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__)))
+        daemon = subprocess.Popen(
+            [sys.executable, "-m", "cppimport", "serve", "--socket", socket_path],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        try:
+            for _ in range(100):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.1)
+            monkeypatch.setitem(cppimport.settings, "daemon_socket", socket_path)
+            monkeypatch.setattr(cppimport.importer, "template_and_build", None)
+
+            # Concurrent requests for the same module are built once.
+            filepath = os.path.join(tmp_path, "hook_test.cpp")
+            module_data = setup_module_data("hook_test", filepath)
+            with concurrent.futures.ThreadPoolExecutor(2) as executor:
+                results = list(executor.map(request_build, [module_data] * 2))
+            assert results == [True, True]
+            build_safely(filepath, module_data)
+            assert cppimport.checksum.is_checksum_valid(module_data)
+        finally:
+            daemon.terminate()
+            output = daemon.communicate()[0].decode("utf-8")
+            print(output)
+        assert output.count("Built hook_test") == 1
+        assert not os.path.exists(socket_path)
+
+    # Without a daemon, modules are built in this process.
+    assert not request_build(module_data)
+
+
+def test_build_daemon_rejects_other_settings(monkeypatch):
+    from cppimport.daemon import request_build
+    from cppimport.importer import setup_module_data
+
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        socket_path = os.path.join(tmp_path, "daemon.sock")
+        env = dict(
+            os.environ,
+            PYTHONPATH=os.path.dirname(os.path.dirname(__file__)),
+            CPPIMPORT_PGO="generate",
+        )
+        daemon = subprocess.Popen(
+            [sys.executable, "-m", "cppimport", "serve", "--socket", socket_path],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        try:
+            for _ in range(100):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.1)
+            monkeypatch.setitem(cppimport.settings, "daemon_socket", socket_path)
+            module_data = setup_module_data(
+                "hook_test", os.path.join(tmp_path, "hook_test.cpp")
+            )
+            # An instrumented build mustn't end up at the regular extension path.
+            assert not request_build(module_data)
+            assert not os.path.exists(module_data["ext_path"])
+        finally:
+            daemon.terminate()
+            output = daemon.communicate()[0].decode("utf-8")
+            print(output)
+        assert "different build settings than the daemon: pgo" in output
+
+
+def test_build_daemon_builds_concurrently(monkeypatch):
+    from cppimport.daemon import BuildServer, request_build
+    from cppimport.importer import setup_module_data
+
+    # The server runs in this process and mustn't send builds to itself.
+    monkeypatch.setitem(cppimport.settings, "use_daemon", False)
+    with tmp_dir() as tmp_path:
+        module_datas = []
+        for d in ["a", "b"]:
+            os.mkdir(os.path.join(tmp_path, d))
+            filepath = os.path.join(tmp_path, d, "hook_test.cpp")
+            shutil.copyfile("tests/hook_test.cpp", filepath)
+            module_datas.append(setup_module_data("hook_test", filepath))
+
+        socket_path = os.path.join(tmp_path, "daemon.sock")
+        monkeypatch.setitem(cppimport.settings, "daemon_socket", socket_path)
+        with builds_overlap(monkeypatch):
+            server = BuildServer(socket_path)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            try:
+                with concurrent.futures.ThreadPoolExecutor(2) as executor:
+                    results = list(executor.map(request_build, module_datas))
+            finally:
+                server.shutdown()
+                server.server_close()
+    assert results == [True, True]
+
+
+def test_lock_waiters_wake_up_when_build_finishes(monkeypatch):
+    import filelock
+
+    import cppimport.importer
+    from cppimport.importer import build_safely, setup_module_data, template_and_build
+
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        filepath = os.path.join(tmp_path, "hook_test.cpp")
+        module_data = setup_module_data("hook_test", filepath)
+        template_and_build(filepath, module_data)
+
+        checks = []
+        orig_is_checksum_valid = cppimport.importer.is_checksum_valid
+        monkeypatch.setattr(
+            cppimport.importer,
+            "is_checksum_valid",
+            lambda md: checks.append(md) or orig_is_checksum_valid(md),
+        )
+        monkeypatch.setattr(cppimport.importer, "template_and_build", None)
+        monkeypatch.setitem(cppimport.settings, "use_filelock", True)
+
+        # Pretend that another process is building the module.
+        lock_path = module_data["ext_path"] + cppimport.settings["lock_suffix"]
+        builder_lock = filelock.FileLock(lock_path)
+        builder_lock.acquire()
+        waiter = threading.Thread(target=build_safely, args=(filepath, module_data))
+        waiter.start()
+        time.sleep(0.5)
+        assert waiter.is_alive()
+        released = time.time()
+        builder_lock.release()
+        waiter.join()
+        assert time.time() - released < 0.5
+        assert len(checks) == 1
+
+
+def test_trace(monkeypatch):
+    import json
+
+    import cppimport.trace
+
+    monkeypatch.setitem(cppimport.settings, "use_filelock", True)
+    events = []
+    cppimport.trace.add_listener(events.append)
+    try:
+        with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+            filepath = os.path.join(tmp_path, "hook_test.cpp")
+            cppimport.imp_from_filepath(filepath, "hook_test")
+    finally:
+        cppimport.trace.remove_listener(events.append)
+    phases = [e["phase"] for e in events]
+    for phase in ["checksum", "lock", "templating", "build", "trailer", "load"]:
+        assert phase in phases
+    assert all(e["module"] == "hook_test" for e in events)
+    assert all(e["duration"] >= 0 for e in events)
+
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        trace_path = os.path.join(tmp_path, "trace.json")
+        test_code = f"""
+import sys;
+sys.path.insert(0, '{tmp_path}');
+import cppimport, cppimport.import_hook;
+cppimport.settings['trace'] = '{trace_path}';
+import hook_test;
+"""
+        subprocess_check(test_code)
+        with open(trace_path) as f:
+            trace = json.load(f)
+    names = [e["name"] for e in trace["traceEvents"]]
+    assert "find" in names and "build" in names and "load" in names
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in trace["traceEvents"])
+
+
+def test_template_only_changes_do_not_recompile(monkeypatch):
+    import cppimport.build_module
+    from cppimport.importer import setup_module_data, template_and_build
+
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        filepath = os.path.join(tmp_path, "hook_test.cpp")
+        module_data = setup_module_data("hook_test", filepath)
+        template_and_build(filepath, module_data)
+
+        def fail(module_data):
+            raise AssertionError("The module was compiled.")
+
+        monkeypatch.setattr(cppimport.build_module, "build_module", fail)
+        with open(filepath) as f:
+            src = f.read()
+        with open(filepath, "w") as f:
+            f.write(src.replace("setup_pybind11(cfg)", "setup_pybind11( cfg )  "))
+        module_data = setup_module_data("hook_test", filepath)
+        assert not cppimport.checksum.is_checksum_valid(module_data)
+        template_and_build(filepath, module_data)
+        assert cppimport.checksum.is_checksum_valid(module_data)
+        assert cppimport.imp_from_filepath(filepath).sub(3, 1) == 2
+
+        # Changes to the rendered source are compiled.
+        with open(filepath, "a") as f:
+            f.write("\n// changed\n")
+        module_data = setup_module_data("hook_test", filepath)
+        with pytest.raises(AssertionError, match="compiled"):
+            template_and_build(filepath, module_data)
+
+
+def test_toolchain_changes_invalidate_checksum(monkeypatch):
+    from cppimport.importer import setup_module_data, template_and_build
+    from cppimport.toolchain import changed_components, trailer_components
+
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        filepath = os.path.join(tmp_path, "hook_test.cpp")
+        module_data = setup_module_data("hook_test", filepath)
+        template_and_build(filepath, module_data)
+        trailer = cppimport.checksum._load_checksum_trailer(module_data)
+        assert set(trailer["toolchain"]) == {"python", "flags", "compiler", "pybind11"}
+        assert cppimport.checksum.is_checksum_valid(module_data)
+
+        monkeypatch.setenv("CFLAGS", "-O1")
+        assert not cppimport.checksum.is_checksum_valid(module_data)
+        # A template-only change must not reuse the extension either.
+        module_data["rendered_src_filepath"] = (
+            cppimport.templating.get_rendered_source_filepath(filepath)
+        )
+        module_data["cfg"] = cppimport.templating.evaluate_cfg(module_data)
+        assert not cppimport.checksum.is_rendered_source_unchanged(module_data)
+        monkeypatch.delenv("CFLAGS")
+        assert cppimport.checksum.is_checksum_valid(module_data)
+
+    components = trailer_components({})
+    assert "pybind11" not in components
+    assert changed_components(components) == []
+    # A reinstalled compiler of the same version is the same compiler.
+    compiler = dict(components["compiler"], stat=None)
+    assert changed_components(dict(components, compiler=compiler)) == []
+    compiler["version"] = "other"
+    assert changed_components(dict(components, compiler=compiler)) == ["compiler"]
+    # Without a compiler the extension can't be rebuilt, so keep using it.
+    monkeypatch.setenv("CC", "no-such-compiler")
+    assert changed_components(dict(compiler=compiler)) == []
+    monkeypatch.delenv("CC")
+    assert changed_components(dict(python="other", pybind11="0.0")) == [
+        "python",
+        "pybind11",
+    ]
+
+
+def test_build_profiles(monkeypatch):
+    from cppimport.importer import setup_module_data
+
+    src = """<%
+setup_pybind11(cfg)
+cfg['profile'] = 'release'
+%>
+#include <pybind11/pybind11.h>
+PYBIND11_MODULE(profiled, m) {
+#ifdef NDEBUG
+    m.attr("ndebug") = true;
+#else
+    m.attr("ndebug") = false;
+#endif
+}
+"""
+    with tmp_dir() as tmp_path:
+        filepath = os.path.join(tmp_path, "profiled.cpp")
+        with open(filepath, "w") as f:
+            f.write(src)
+        assert cppimport.imp_from_filepath(filepath).ndebug
+        trailer = cppimport.checksum._load_checksum_trailer(
+            setup_module_data("profiled", filepath)
+        )
+        assert trailer["toolchain"]["profile"]["name"] == "release"
+
+        # The setting overrides the configuration and both builds coexist. Two
+        # extensions with the same name can't be loaded into one process.
+        test_code = f"""
+import cppimport;
+cppimport.settings["build_profile"] = "debug";
+assert not cppimport.imp_from_filepath('{filepath}').ndebug;
+"""
+        subprocess_check(test_code)
+        monkeypatch.setitem(cppimport.settings, "build_profile", "debug")
+        module_data = setup_module_data("profiled", filepath)
+        assert ".debug." in module_data["ext_name"]
+        assert sorted(f for f in os.listdir(tmp_path) if f.endswith(".so")) == [
+            "profiled" + cppimport.importer.get_extension_suffix(),
+            "profiled.debug" + cppimport.importer.get_extension_suffix(),
+        ]
+        assert cppimport.checksum.is_checksum_valid(module_data)
+
+        monkeypatch.setitem(cppimport.settings, "build_profile", "fastest")
+        with pytest.raises(ValueError, match="Unknown build profile"):
+            cppimport.imp_from_filepath(filepath)
+
+
+def test_pgo(monkeypatch):
+    from cppimport.importer import setup_module_data, template_and_build
+    from cppimport.pgo import data_filepaths, get_pgo_dir
+
+    src = """<%
+setup_pybind11(cfg)
+%>
+#include <pybind11/pybind11.h>
+int collatz(int n) {
+    int steps = 0;
+    for (; n != 1; steps++) {
+        n = n % 2 ? 3 * n + 1 : n / 2;
+    }
+    return steps;
+}
+PYBIND11_MODULE(pgo_test, m) { m.def("collatz", collatz); }
+"""
+    with tmp_dir() as tmp_path:
+        monkeypatch.setitem(cppimport.settings, "cache_dir", tmp_path)
+        filepath = os.path.join(tmp_path, "pgo_test.cpp")
+        with open(filepath, "w") as f:
+            f.write(src)
+
+        monkeypatch.setitem(cppimport.settings, "pgo", "generate")
+        module_data = setup_module_data("pgo_test", filepath)
+        template_and_build(filepath, module_data)
+        assert cppimport.checksum.is_checksum_valid(module_data)
+        # The profile data is written when the workload exits.
+        assert data_filepaths(module_data) == []
+        test_code = f"""
+import cppimport;
+cppimport.settings["cache_dir"] = '{tmp_path}';
+cppimport.settings["pgo"] = "generate";
+m = cppimport.imp_from_filepath('{filepath}');
+assert m.collatz(27) == 111;
+"""
+        subprocess_check(test_code)
+        data = data_filepaths(module_data)
+        assert data
+
+        # Builds in each mode have their own extension and share the data.
+        monkeypatch.setitem(cppimport.settings, "pgo", "use")
+        use_module_data = setup_module_data("pgo_test", filepath)
+        assert use_module_data["ext_path"] != module_data["ext_path"]
+        assert ".pgo-use." in use_module_data["ext_path"]
+        assert data_filepaths(use_module_data) == data
+        template_and_build(filepath, use_module_data)
+        trailer = cppimport.checksum._load_checksum_trailer(use_module_data)
+        assert trailer["pgo"]["mode"] == "use"
+        assert [d["path"] for d in trailer["pgo"]["data"]] == data
+        assert cppimport.checksum.is_checksum_valid(use_module_data)
+
+        # Profile data is only read if it changed.
+        with monkeypatch.context() as m:
+            m.setattr(cppimport.checksum, "_calc_file_digest", None)
+            assert cppimport.checksum.is_checksum_valid(use_module_data)
+
+        # New profile data results in a rebuild.
+        shutil.rmtree(os.path.join(get_pgo_dir(module_data), "data"))
+        assert not cppimport.checksum.is_checksum_valid(use_module_data)
+
+        # Regular imports don't use or replace the PGO builds.
+        monkeypatch.setitem(cppimport.settings, "pgo", None)
+        assert not os.path.exists(setup_module_data("pgo_test", filepath)["ext_path"])
+        assert not cppimport.checksum.is_checksum_valid(use_module_data)
+
+
+def test_try_load_removes_broken_extension():
+    from cppimport.importer import setup_module_data, try_load
+
+    with tmp_dir(["tests/hook_test.cpp"]) as tmp_path:
+        # A name that was never imported, so nothing is loaded from sys.modules.
+        module_data = setup_module_data(
+            "broken_ext", os.path.join(tmp_path, "hook_test.cpp")
+        )
+        with open(module_data["ext_path"], "wb") as f:
+            f.write(b"not an extension")
+        assert not try_load(module_data)
+        assert not os.path.exists(module_data["ext_path"])